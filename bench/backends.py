@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# Compares the opusenc and ffmpeg (libopus) encoder backends on a synthetic
+# audiobook. Needs ffmpeg (with libmp3lame and libopus) and opusenc.
+
+from pathlib import Path
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from fixtures import make_book
+
+SCRIPT = Path(__file__).resolve().parent.parent / 'overdrive2opus.py'
+
+
+def run(folder: Path, output: Path, encoder: str) -> dict:
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            str(SCRIPT),
+            '--noprogress',
+            '--nocache',
+            # the repeats write the same output, which is up to date after the first
+            '--force',
+            '--encoder',
+            encoder,
+            str(folder),
+            str(output),
+        ],
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        'wall': wall,
+        'user': after.ru_utime - before.ru_utime,
+        'sys': after.ru_stime - before.ru_stime,
+        'voluntary_switches': after.ru_nvcsw - before.ru_nvcsw,
+        'involuntary_switches': after.ru_nivcsw - before.ru_nivcsw,
+        'size': output.stat().st_size,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='compare the opusenc and ffmpeg encoder backends'
+    )
+    parser.add_argument('--parts', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=300, help='seconds per part')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp, 'book')
+        folder.mkdir()
+        make_book(folder, args.parts, args.duration)
+
+        results: dict = {}
+        for _ in range(args.repeat):
+            # interleaved so both see the same machine state
+            for encoder in ('opusenc', 'ffmpeg'):
+                r = run(folder, Path(tmp, f'{encoder}.opus'), encoder)
+                results.setdefault(encoder, []).append(r)
+
+    # best of the repeats
+    summary = {
+        encoder: min(runs, key=lambda r: r['wall']) for encoder, runs in results.items()
+    }
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
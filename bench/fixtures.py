@@ -0,0 +1,101 @@
+# Synthetic OverDrive style audiobook folders for the benchmarks. Everything
+# is generated with ffmpeg (libmp3lame), nothing is downloaded.
+
+from pathlib import Path
+import subprocess
+
+SOURCES = {
+    'tone': 'sine=f=220:d={d}',
+    'noise': 'anoisesrc=d={d}:c=pink:a=0.3',
+    # pink noise, band limited to the voice range and chopped at syllable rate
+    'speech': (
+        'anoisesrc=d={d}:c=pink:a=0.5,highpass=f=200,lowpass=f=3500,'
+        'volume=\'0.55+0.45*sin(2*PI*4*t)*sin(2*PI*0.3*t)\':eval=frame'
+    ),
+}
+
+
+def _markers(part: int, duration: float, subchapters: int) -> str:
+    markers = ['<Markers>']
+    for n in range(subchapters + 1):
+        t = duration * n / (subchapters + 1)
+        if 0 == n:
+            name = f'Chapter {part}'
+        else:
+            name = f'   Chapter {part} ({n})'
+        minutes, seconds = divmod(t, 60)
+        markers.append(
+            f'<Marker><Name>{name}</Name>'
+            f'<Time>{int(minutes)}:{seconds:06.3f}</Time></Marker>'
+        )
+    markers.append('</Markers>')
+    return ''.join(markers)
+
+
+def make_book(
+    folder: Path,
+    parts: int = 4,
+    duration: float = 300,
+    source: str = 'speech',
+    subchapters: int = 2,
+    title: str = 'Benchmark',
+) -> Path:
+    folder = Path(folder)
+    folder.mkdir(exist_ok=True, parents=True)
+
+    for n in range(1, parts + 1):
+        subprocess.run(
+            [
+                'ffmpeg',
+                '-loglevel',
+                'error',
+                '-y',
+                '-f',
+                'lavfi',
+                '-i',
+                SOURCES[source].format(d=duration),
+                '-ac',
+                '2',
+                '-ar',
+                '44100',
+                '-c:a',
+                'libmp3lame',
+                '-b:a',
+                '64k',
+                '-id3v2_version',
+                '3',
+                '-metadata',
+                f'title={title} - Part {n:02d}',
+                '-metadata',
+                f'album={title}',
+                '-metadata',
+                'artist=Synthetic Author',
+                '-metadata',
+                f'track={n}',
+                '-metadata',
+                f'OverDrive MediaMarkers={_markers(n, duration, subchapters)}',
+                str(folder / f'{title} - Part {n:02d}.mp3'),
+            ],
+            check=True,
+        )
+
+    # two covers, the bigger one is the real one
+    for name, size in (('cover.jpg', '600x600'), ('thumb.jpg', '100x100')):
+        subprocess.run(
+            [
+                'ffmpeg',
+                '-loglevel',
+                'error',
+                '-y',
+                '-f',
+                'lavfi',
+                '-i',
+                f'testsrc=s={size}',
+                '-frames:v',
+                '1',
+                str(folder / name),
+            ],
+            check=True,
+        )
+
+    return folder
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+# Times every stage of a conversion on a synthetic book and prints the
+# results as JSON, so they can be compared between releases.
+
+from pathlib import Path
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import overdrive2opus as o2o  # noqa: E402
+from fixtures import SOURCES, make_book  # noqa: E402
+
+
+def _run(params: list) -> dict:
+    # runs one process, counting what it writes to stdout
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [str(p) for p in params],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    piped = 0
+    assert process.stdout is not None
+    while chunk := process.stdout.read(1 << 16):
+        piped += len(chunk)
+    process.stdout.close()
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(f'{params[0]} failed with {process.returncode}')
+
+    return {
+        'wall': time.perf_counter() - start,
+        'cpu_user': usage.ru_utime,
+        'cpu_sys': usage.ru_stime,
+        'peak_rss_kb': usage.ru_maxrss,
+        'bytes_piped': piped,
+    }
+
+
+def _in_process(f, *args, **kwargs) -> dict:
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    f(*args, **kwargs)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        'wall': wall,
+        'cpu_user': after.ru_utime
+        - before.ru_utime
+        + after_children.ru_utime
+        - children.ru_utime,
+        'cpu_sys': after.ru_stime
+        - before.ru_stime
+        + after_children.ru_stime
+        - children.ru_stime,
+        # high water marks, not per stage
+        'peak_rss_kb': max(after.ru_maxrss, after_children.ru_maxrss),
+        'bytes_piped': 0,
+    }
+
+
+def benchmark(folder: Path, output: Path, options: dict) -> dict:
+    stages = {}
+    files = sorted(folder.glob('*.mp3'))
+
+    probed = {}
+
+    def _probe() -> None:
+        for f in files:
+            probed[f] = o2o.get_metadata(f, cache=False)
+
+    stages['probe'] = _in_process(_probe)
+
+    # the merge alone, with the probe results handed back
+    get_metadata = o2o.get_metadata
+    o2o.get_metadata = lambda f, cache=True: dict(probed[f])
+    try:
+        stages['merge'] = _in_process(
+            o2o.get_folder_metadata,
+            folder,
+            options['subchapters'],
+            probe_jobs=1,
+            cache=False,
+        )
+        metadata = o2o.get_folder_metadata(
+            folder, options['subchapters'], probe_jobs=1, cache=False
+        )
+    finally:
+        o2o.get_metadata = get_metadata
+
+    duration = metadata['duration']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        concat = None
+        listing = o2o._concat_list(metadata['files'])
+        if listing is not None:
+            concat = Path(tmp, 'files.txt')
+            concat.write_text(listing, encoding='utf-8')
+
+        raw_rate = options['rate']
+
+        def _ffmpeg(filters: list[str]) -> dict:
+            return _run(
+                o2o._ffmpeg_params(
+                    metadata['files'],
+                    filters,
+                    o2o._pcm_output(raw_rate),
+                    concat=concat,
+                    progress=False,
+                )
+            )
+
+        stages['decode'] = _ffmpeg([])
+        stages['filter'] = _ffmpeg(
+            o2o._filters(
+                options['speed'],
+                options['normalize'],
+                options['isolate_voice'],
+                options['af'],
+            )
+        )
+
+    stages['encode'] = _in_process(
+        o2o.encode, folder, output, progress=False, **options
+    )
+
+    for stage in stages.values():
+        stage['realtime_factor'] = duration / stage['wall'] if stage['wall'] else None
+
+    return {'audio_duration': duration, 'stages': stages}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='time every conversion stage on a synthetic audiobook'
+    )
+    parser.add_argument('--parts', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=300, help='seconds per part')
+    parser.add_argument('--source', choices=sorted(SOURCES), default='speech')
+    parser.add_argument('--bitrate', type=int, default=15)
+    parser.add_argument('--speed', type=int, default=0)
+    parser.add_argument('--normalize', type=int, default=None)
+    parser.add_argument('--isolate_voice', action='store_true')
+    parser.add_argument('--filter', type=str, default=None)
+    parser.add_argument('--encoder', choices=('opusenc', 'ffmpeg'), default='opusenc')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--rate', type=int, default=48000)
+    parser.add_argument('--folder', type=str, help='use this book instead')
+    parser.add_argument('--output', type=str, help='write the JSON here')
+    args = parser.parse_args()
+
+    options = {
+        'bitrate': args.bitrate,
+        'subchapters': False,
+        'af': args.filter,
+        'speed': args.speed,
+        'normalize': args.normalize,
+        'isolate_voice': args.isolate_voice,
+        'cache': False,
+        'jobs': args.jobs,
+        'encoder': args.encoder,
+        'rate': args.rate,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.folder is None:
+            folder = make_book(
+                Path(tmp, 'book'), args.parts, args.duration, args.source
+            )
+        else:
+            folder = Path(args.folder)
+
+        report = benchmark(folder, Path(tmp, 'book.opus'), options)
+
+    ffmpeg_version = subprocess.run(
+        ['ffmpeg', '-version'], capture_output=True, text=True
+    ).stdout.split('\n')[0]
+
+    report.update(
+        {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'ffmpeg': ffmpeg_version,
+            'cpus': os.cpu_count(),
+            'fixture': {
+                'parts': args.parts,
+                'duration': args.duration,
+                'source': args.source,
+                'folder': args.folder,
+            },
+            'options': options,
+        }
+    )
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
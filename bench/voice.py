@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# Compares a single arnndn pass with the chunked, parallel voice isolation of
+# --voice_jobs on a synthetic book: throughput of both and how far the
+# crossfaded seams are from the single pass output. Needs ffmpeg (with
+# libmp3lame) and the noise model (downloaded and cached on first use).
+
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import overdrive2opus as o2o  # noqa: E402
+from fixtures import SOURCES, make_book  # noqa: E402
+
+
+def _run(params: list) -> tuple[float, bytes]:
+    start = time.perf_counter()
+    pcm = subprocess.run(
+        params,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    ).stdout
+    return time.perf_counter() - start, pcm
+
+
+def _chunked(model: str, decoder: list, jobs: int) -> tuple[float, array]:
+    out = bytearray()
+
+    async def _write(data: bytes) -> None:
+        out.extend(data)
+
+    start = time.perf_counter()
+    asyncio.run(o2o._isolate_voice(model, decoder, jobs, _write))
+    return time.perf_counter() - start, array('h', out)
+
+
+def _snr(reference: array, other: array, start: int, end: int) -> float:
+    signal = sum(x * x for x in reference[start:end])
+    noise = sum((x - y) ** 2 for x, y in zip(reference[start:end], other[start:end]))
+    if 0 == noise:
+        return math.inf
+    if 0 == signal:
+        return -math.inf
+    return 10 * math.log10(signal / noise)
+
+
+def _max_step(pcm: array, start: int, end: int) -> int:
+    return max(abs(pcm[n + 1] - pcm[n]) for n in range(start, end - 1))
+
+
+def seams(reference: array, chunked: array) -> dict:
+    rate = o2o.VOICE_RATE
+    window = int(o2o.VOICE_CROSSFADE * rate)
+    chunk = o2o.VOICE_CHUNK * rate
+    largest = _max_step(reference, 0, len(reference))
+
+    report = []
+    for seam in range(chunk, len(reference), chunk):
+        start, end = seam - 2 * window, min(seam + window, len(reference))
+        report.append(
+            {
+                'time': seam / rate,
+                'snr_db': _snr(reference, chunked, start, end),
+                # a click is a step no ordinary sample shows
+                'step_ratio': (
+                    _max_step(chunked, start, end) / largest if largest else 0
+                ),
+            }
+        )
+
+    worst_snr = min((s['snr_db'] for s in report), default=math.inf)
+    worst_step = max((s['step_ratio'] for s in report), default=0)
+    return {
+        'same_length': len(reference) == len(chunked),
+        'snr_db': _snr(reference, chunked, 0, len(reference)),
+        'worst_seam_snr_db': worst_snr,
+        'worst_seam_step_ratio': worst_step,
+        'inaudible': worst_snr >= 30 and worst_step <= 1,
+        'seams': report,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='single pass against chunked parallel voice isolation'
+    )
+    parser.add_argument('--parts', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=300, help='seconds per part')
+    parser.add_argument('--source', choices=sorted(SOURCES), default='speech')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        nargs='+',
+        default=sorted({2, os.cpu_count() or 1}),
+        help='--voice_jobs values to try',
+    )
+    parser.add_argument('--model', type=str, help='rnnoise model to use')
+    parser.add_argument('--folder', type=str, help='use this book instead')
+    args = parser.parse_args()
+
+    model = args.model if args.model is not None else o2o._get_noise_model()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.folder is None:
+            folder = make_book(
+                Path(tmp, 'book'), args.parts, args.duration, args.source
+            )
+        else:
+            folder = Path(args.folder)
+
+        metadata = o2o.get_folder_metadata(folder, False, probe_jobs=1, cache=False)
+        concat = None
+        listing = o2o._concat_list(metadata['files'])
+        if listing is not None:
+            concat = Path(tmp, 'files.txt')
+            concat.write_text(listing, encoding='utf-8')
+
+        def _decoder(filters: list[str]) -> list[str]:
+            return [
+                str(p)
+                for p in o2o._ffmpeg_params(
+                    metadata['files'],
+                    filters,
+                    o2o._pcm_output(o2o.VOICE_RATE),
+                    concat=concat,
+                    progress=False,
+                )
+            ]
+
+        decoder = _decoder([])
+        duration = metadata['duration']
+        wall, _ = _run(_decoder([f'arnndn=m={model}']))
+
+        # seams are compared with one arnndn pass over the very same PCM
+        _, pcm = _run(decoder)
+        reference = array('h', asyncio.run(o2o._arnndn(model, pcm)))
+
+        report: dict = {
+            'audio_duration': duration,
+            'cpus': os.cpu_count(),
+            'single': {'wall': wall, 'realtime_factor': duration / wall},
+        }
+
+        for jobs in args.jobs:
+            wall, chunked = _chunked(model, decoder, jobs)
+            report[f'jobs_{jobs}'] = {
+                'wall': wall,
+                'realtime_factor': duration / wall,
+                'seams': seams(reference, chunked),
+            }
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,61 @@
 #!/usr/bin/python3
 
-from typing import Optional, Union
+from typing import (
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Union,
+)
 import logging as log
+import os
 import subprocess
-from io import TextIOWrapper
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import mmap
+import struct
+import zlib
+import asyncio
+import time
+import resource
+import signal
 import json
+import atexit
+import base64
+import io
+import math
+from array import array
+from bisect import bisect_left
+from collections import deque
 import re
 import xml.etree.ElementTree as ET
 from html import unescape
 from pathlib import Path
-from urllib.request import urlretrieve
 import argparse
-from appdirs import user_cache_dir
-
-from rich.logging import RichHandler
-from rich.traceback import install as traceback_install
-from rich.progress import (
-    Progress,
-    BarColumn,
-    TimeRemainingColumn,
-    TextColumn,
-    Column,
-    SpinnerColumn,
-)
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from functools import partial, wraps
 
-from argparse import HelpFormatter as Formatter
+# rich, rich_argparse and appdirs are imported where they are used so that
+# importing this module (or --help) stays cheap
 
-try:
-    from rich_argparse import RichHelpFormatter as Formatter
-except ImportError:
-    pass
+__all__ = [
+    'clear_cache',
+    'encode',
+    'encode_async',
+    'encode_batch',
+    'get_folder_metadata',
+    'get_metadata',
+    'main',
+    'retag',
+    'sweep',
+    'verify_opus',
+]
 
 APPNAME = 'overdrive2opus'
 
@@ -38,30 +64,160 @@ NOISE_MODEL_URL = (
     'rnnoise-models/master/somnolent-hogwash-2018-09-01/sh.rnnn'
 )
 
+# bump whenever the structure of cached data changes
+CACHE_VERSION = 2
+METADATA_CACHE_SIZE = 16 * 1024 * 1024
+LOUDNESS_CACHE_SIZE = 1024 * 1024
+SILENCE_CACHE_SIZE = 4 * 1024 * 1024
+# decoded (and voice isolated) books as FLAC, --pcm_cache without a size
+PCM_CACHE_SIZE = 8 * 1024 * 1024 * 1024
+# covers taken out of the mp3 ID3 tags or downscaled by --cover_size
+COVER_CACHE_SIZE = 64 * 1024 * 1024
+
+# cover candidates in a book folder, by extension
+COVER_EXTENSIONS = ('jpg', 'jpeg', 'png')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# characters of OverDrive MediaMarkers XML parsed at a time
+MARKERS_CHUNK = 64 * 1024
+
+# pauses (dBFS, seconds) that segments and chunks are preferably cut at
+SILENCE_NOISE = -40
+SILENCE_DURATION = 0.25
+
+# --sweep defaults: kbit/s to try, and how many excerpts of how many seconds
+SWEEP_BITRATES = (8, 10, 12, 15, 20, 24, 32)
+SWEEP_EXCERPTS = 5
+SWEEP_SECONDS = 30
+
+# seconds the audio of a verified output may differ from the expected duration
+VERIFY_TOLERANCE = 1.0
+
+# --loudnorm never raises the true peak above this (dBTP)
+LOUDNORM_TRUE_PEAK = -1.0
+
+# --voice_jobs chunks, in seconds. arnndn works on 10 ms frames, all of
+# these keep the chunks on the same frame grid as a single pass would.
+VOICE_CHUNK = 60
+VOICE_WARMUP = 2
+VOICE_CROSSFADE = 0.5
+VOICE_RATE = 48000
+VOICE_FRAME = 480
+
+# opus comment recording what an output was made from
+MANIFEST_TAG = 'OVERDRIVE2OPUS_MANIFEST'
+# where the segments of a stitched output start, so retag can shift chapters
+SEAMS_TAG = 'OVERDRIVE2OPUS_SEAMS'
+MANIFEST_VERSION = 1
+
 
 def __init_logging(verbose: bool):
+    from rich.logging import RichHandler
+
     if verbose:
+        from rich.traceback import install as traceback_install
+
         traceback_install(show_locals=True)
         log.basicConfig(level=log.DEBUG, handlers=[RichHandler(rich_tracebacks=True)])
-        log.debug('args = %r', args)
     else:
         log.basicConfig(
             level=log.WARNING, handlers=[RichHandler(rich_tracebacks=False)]
         )
 
 
+def _user_cache_dir() -> str:
+    from appdirs import user_cache_dir
+
+    return user_cache_dir(APPNAME)
+
+
 # I dont' want to ship this due to unknown license
 def _get_noise_model() -> str:
-    filename = Path(user_cache_dir(APPNAME), 'voice.rnnn')
+    filename = Path(_user_cache_dir(), 'voice.rnnn')
     log.debug('noise_filename = %r', filename)
     if not filename.exists():
         directory = filename.parent
         directory.mkdir(exist_ok=True, parents=True)
         log.info('Downloading voice/noise model from %r', NOISE_MODEL_URL)
+        from urllib.request import urlretrieve
+
         urlretrieve(NOISE_MODEL_URL, filename)
     return str(filename)
 
 
+def _cache_dir(kind: str) -> Path:
+    return Path(_user_cache_dir(), kind)
+
+
+def _file_key(fname: Path) -> str:
+    st = fname.stat()
+    key = f'{CACHE_VERSION}:{fname.resolve()}:{st.st_size}:{st.st_mtime_ns}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _cache_load(kind: str, key: str):
+    filename = _cache_dir(kind) / (key + '.json')
+    try:
+        with open(filename, 'rb') as f:
+            ret = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        log.warning('Ignoring broken cache entry %r', filename)
+        return None
+
+    # eviction is by least recently used, so touch it
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+
+    log.debug('Cache hit %r', filename)
+    return ret
+
+
+def _cache_store(kind: str, key: str, value) -> None:
+    directory = _cache_dir(kind)
+    try:
+        directory.mkdir(exist_ok=True, parents=True)
+        # write and rename so concurrent readers never see partial entries
+        with tempfile.NamedTemporaryFile(
+            'w', dir=directory, suffix='.tmp', delete=False
+        ) as f:
+            json.dump(value, f)
+        os.replace(f.name, directory / (key + '.json'))
+    except OSError as e:
+        log.warning('Could not write cache entry in %r: %s', directory, e)
+
+
+def _cache_evict(kind: str, max_size: int, pattern: str = '*.json') -> None:
+    directory = _cache_dir(kind)
+    entries = []
+    try:
+        for f in directory.glob(pattern):
+            st = f.stat()
+            entries.append((st.st_mtime, st.st_size, f))
+    except OSError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+
+    for _, size, f in entries:
+        if total <= max_size:
+            break
+        log.debug('Evicting cache entry %r', f)
+        f.unlink(missing_ok=True)
+        total -= size
+
+
+def clear_cache() -> None:
+    for kind in ('metadata', 'loudness', 'silence', 'pcm', 'cover'):
+        directory = _cache_dir(kind)
+        log.info('Clearing cache %r', directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 def _str2bytes(s: str | bytes) -> bytes:
     if isinstance(s, bytes):
         return s
@@ -115,6 +271,283 @@ def _ts_from_time(s: str) -> float:
     return ret
 
 
+# ffprobe tag names for the ID3 frames we care about
+ID3_FRAMES = {
+    'TIT2': 'title',
+    'TPE1': 'artist',
+    'TALB': 'album',
+    'TRCK': 'track',
+    'TCON': 'genre',
+    'TPUB': 'publisher',
+    'TCOP': 'copyright',
+}
+
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+MPEG_BITRATES = {
+    # MPEG 1 layer III
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    # MPEG 2 and 2.5 layer III
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+MPEG_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+def _syncsafe(b: bytes) -> int:
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+
+def _id3_strings(data: bytes) -> list[str]:
+    if not data:
+        return []
+
+    encoding = data[0]
+    if encoding >= len(ID3_ENCODINGS):
+        log.debug('Unknown ID3 text encoding %r', encoding)
+        return []
+
+    codec = ID3_ENCODINGS[encoding]
+    data = data[1:]
+
+    if encoding in (0, 3):
+        return data.decode(codec, errors='replace').rstrip('\0').split('\0')
+
+    # UTF-16 terminators are two aligned nulls and every string has its own BOM
+    ret = []
+    start = 0
+    for i in range(0, len(data) - 1, 2):
+        if data[i : i + 2] == b'\0\0':
+            ret.append(data[start:i].decode(codec, errors='replace'))
+            start = i + 2
+    if start < len(data) - 1:
+        ret.append(data[start:].decode(codec, errors='replace'))
+    return ret
+
+
+def _id3_header(f) -> Optional[tuple[int, int, int]]:
+    # (version, flags, end) of an ID3v2 tag the native reader supports, with f
+    # at its first frame
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return None
+
+    version = header[3]
+    flags = header[5]
+    size = _syncsafe(header[6:10])
+
+    # unsynchronised 2.3 tags or anything older than 2.3 go through ffprobe
+    if version not in (3, 4) or (3 == version and flags & 0x80):
+        log.debug('Unsupported ID3v2.%d tag (flags %#x)', version, flags)
+        return None
+
+    if flags & 0x40:
+        ext = f.read(4)
+        if 4 == version:
+            ext_size = _syncsafe(ext) - 4
+        else:
+            ext_size = int.from_bytes(ext, 'big')
+        f.seek(ext_size, os.SEEK_CUR)
+
+    return version, flags, 10 + size
+
+
+def _id3_frames(
+    f, version: int, end: int, wanted: Iterable[str]
+) -> Iterator[tuple[str, int, int, bool]]:
+    # (frame id, start, end, unsynchronised) of the wanted frames up to end,
+    # start past the grouping and length bytes. Compressed and encrypted
+    # frames are skipped, and frames the file is too short for. The caller
+    # may move f, the next frame is read from where this one ends.
+    end = min(end, os.fstat(f.fileno()).st_size)
+
+    while f.tell() + 10 <= end:
+        header = f.read(10)
+        # padding
+        if len(header) < 10 or header[0] == 0:
+            break
+
+        if 4 == version:
+            frame_size = _syncsafe(header[4:8])
+        else:
+            frame_size = int.from_bytes(header[4:8], 'big')
+        flags = header[9]
+        frame_id = header[:4].decode('latin-1')
+        frame_end = f.tell() + frame_size
+
+        if frame_id in wanted and frame_end <= end:
+            if 4 == version:
+                skip = flags & 0x0C
+                extra = (1 if flags & 0x40 else 0) + (4 if flags & 0x01 else 0)
+                unsynchronised = bool(flags & 0x02)
+            else:
+                skip = flags & 0xC0
+                extra = 1 if flags & 0x20 else 0
+                unsynchronised = False
+
+            if not skip:
+                yield frame_id, f.tell() + extra, frame_end, unsynchronised
+
+        f.seek(frame_end)
+
+
+def _read_id3(f) -> Optional[dict]:
+    header = _id3_header(f)
+    # no ID3v2 tag, maybe ID3v1 or APE at the end, which ffprobe reads
+    if header is None:
+        return None
+    version, flags, end = header
+
+    tags: dict = {}
+    wanted = set(ID3_FRAMES) | {'TXXX', 'COMM'}
+    for frame_id, start, frame_end, unsynchronised in _id3_frames(
+        f, version, end, wanted
+    ):
+        f.seek(start)
+        data = f.read(frame_end - start)
+        if unsynchronised:
+            data = data.replace(b'\xff\x00', b'\xff')
+        strings = _id3_strings(data)
+
+        if 'COMM' == frame_id:
+            # encoding, language, description, text
+            strings = _id3_strings(data[:1] + data[4:])
+            if len(strings) >= 2 and not strings[0]:
+                tags.setdefault('comment', strings[1])
+        elif 'TXXX' == frame_id:
+            if len(strings) >= 2:
+                tags[strings[0]] = strings[1]
+        elif strings:
+            tags[ID3_FRAMES[frame_id]] = strings[0]
+
+    # footer
+    audio_start = end + (10 if flags & 0x10 else 0)
+    f.seek(audio_start)
+
+    return tags
+
+
+def _mpeg_header(b: bytes) -> Optional[tuple[int, int, int, int]]:
+    if len(b) < 4 or b[0] != 0xFF or (b[1] & 0xE0) != 0xE0:
+        return None
+
+    version = (b[1] >> 3) & 0x03
+    layer = (b[1] >> 1) & 0x03
+    bitrate_index = b[2] >> 4
+    rate_index = (b[2] >> 2) & 0x03
+
+    # only layer III, no free format
+    if 1 == version or 1 != layer or bitrate_index in (0, 15) or 3 == rate_index:
+        return None
+
+    bitrate = MPEG_BITRATES[version][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    samples = 1152 if 3 == version else 576
+    length = samples // 8 * bitrate // sample_rate + ((b[2] >> 1) & 0x01)
+
+    return version, sample_rate, samples, length
+
+
+def _mpeg_info(f, start: int, file_size: int) -> Optional[tuple[float, int, int]]:
+    # skip junk between the tag and the first frame
+    f.seek(start)
+    data = f.read(64 * 1024)
+    offset = data.find(b'\xff')
+    while offset >= 0:
+        header = _mpeg_header(data[offset : offset + 4])
+        if header is not None:
+            break
+        offset = data.find(b'\xff', offset + 1)
+    else:
+        return None
+
+    version, sample_rate, samples, length = header
+    frame = data[offset : offset + length]
+    mono = 3 == ((frame[3] >> 6) & 0x03)
+    channels = 1 if mono else 2
+
+    # Xing/Info header right after the side information
+    if 3 == version:
+        xing = 4 + (17 if mono else 32)
+    else:
+        xing = 4 + (9 if mono else 17)
+
+    if frame[xing : xing + 4] in (b'Xing', b'Info'):
+        xing_flags = int.from_bytes(frame[xing + 4 : xing + 8], 'big')
+        if xing_flags & 0x01:
+            frames = int.from_bytes(frame[xing + 8 : xing + 12], 'big')
+            total = frames * samples
+
+            # encoder delay and padding from the LAME extension (ffmpeg writes
+            # its own name there but the layout is the same)
+            lame = xing + 8
+            lame += sum(
+                n
+                for bit, n in ((0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4))
+                if xing_flags & bit
+            )
+            if frame[lame : lame + 4] in (b'LAME', b'Lavf', b'Lavc'):
+                b = frame[lame + 21 : lame + 24]
+                total -= (b[0] << 4 | b[1] >> 4) + ((b[1] & 0x0F) << 8 | b[2])
+
+            return total / sample_rate, sample_rate, channels
+
+    if frame[36:40] == b'VBRI':
+        frames = int.from_bytes(frame[50:54], 'big')
+        return frames * samples / sample_rate, sample_rate, channels
+
+    # no header, walk every frame
+    f.seek(0)
+    frames = 0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        pos = start + offset
+        while pos + 4 <= file_size:
+            header = _mpeg_header(m[pos : pos + 4])
+            if header is None:
+                break
+            frames += 1
+            pos += header[3]
+
+    # give up if we lost sync too early (ID3v1 and APE tags at the end are fine)
+    if pos < file_size - 64 * 1024:
+        log.debug('Lost MPEG sync at %d of %d', pos, file_size)
+        return None
+
+    return frames * samples / sample_rate, sample_rate, channels
+
+
+def _read_mp3(fname: Path) -> Optional[dict]:
+    try:
+        with open(fname, 'rb') as f:
+            tags = _read_id3(f)
+            if tags is None:
+                return None
+            info = _mpeg_info(f, f.tell(), os.fstat(f.fileno()).st_size)
+    except (OSError, ValueError, IndexError) as e:
+        log.debug('Native mp3 reader failed on %r: %s', fname, e)
+        return None
+
+    if info is None:
+        return None
+
+    duration, sample_rate, channels = info
+
+    # same layout as ffprobe
+    ret = {
+        'format': {'duration': duration, 'tags': tags},
+        'streams': [
+            {'codec_type': 'audio', 'sample_rate': sample_rate, 'channels': channels}
+        ],
+    }
+    log.debug('Raw metadata = %r', ret)
+    return ret
+
+
 def _get_metadata(fname: Path):
     args: list[Union[str | Path]] = [
         'ffprobe',
@@ -123,6 +556,7 @@ def _get_metadata(fname: Path):
         '-print_format',
         'json',
         '-show_format',
+        '-show_streams',
         fname,
     ]
 
@@ -141,8 +575,29 @@ def _int(s: str) -> Optional[int]:
         return None
 
 
-def get_metadata(fname: Path) -> dict:
-    d = _get_metadata(fname)['format']
+def get_metadata(fname: Path, cache: bool = True) -> dict:
+    if not cache:
+        return _parse_metadata(fname)
+
+    key = _file_key(fname)
+    ret = _cache_load('metadata', key)
+    if ret is not None:
+        ret['file'] = fname
+        ret['chapters'] = [tuple(c) for c in ret['chapters']]
+        return ret
+
+    ret = _parse_metadata(fname)
+    _cache_store('metadata', key, dict(ret, file=str(fname)))
+    return ret
+
+
+def _parse_metadata(fname: Path) -> dict:
+    raw = _read_mp3(fname)
+    if raw is None:
+        log.debug('Falling back to ffprobe for %r', fname)
+        raw = _get_metadata(fname)
+
+    d = raw['format']
     t = d['tags']
 
     ret: dict = {'file': fname}
@@ -176,51 +631,313 @@ def get_metadata(fname: Path) -> dict:
     ret['track'] = track
     ret['duration'] = float(d['duration'])
 
+    # needed to know if the parts can be joined by the concat demuxer
+    audio = [s for s in raw.get('streams', []) if 'audio' == s.get('codec_type')]
+    if audio:
+        ret['sample_rate'] = _int(audio[0].get('sample_rate'))
+        ret['channels'] = _int(audio[0].get('channels'))
+    else:
+        ret['sample_rate'] = ret['channels'] = None
+
     # now for the OverDrive chapter information
 
     media_markers = t.get(
         'OverDrive MediaMarkers', "<?xml version=\"1.0\" ?>\n<metadata/>"
     )
-    root = ET.fromstring(media_markers)
-    chapters = []
+    ret['chapters'] = list(_media_markers(media_markers))
+
+    return ret
 
-    for marker in root:
-        if 'Marker' == marker.tag:
-            name: str = 'Unknown name'
-            time: float = 0
-            for child in marker:
-                if 'Name' == child.tag and child.text is not None:
-                    name = child.text
-                if 'Time' == child.tag and child.text is not None:
-                    time = _ts_from_time(child.text)
-
-            chapters.append((name, time))
+
+def _media_markers(xml: str) -> Iterator[tuple[str, float]]:
+    # (name, time) of every marker, parsed incrementally. Each one is dropped
+    # once read, so no tree of thousands of markers is ever built.
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
+    pos = 0
+    while True:
+        chunk = xml[pos : pos + MARKERS_CHUNK]
+        pos += MARKERS_CHUNK
+        if chunk:
+            parser.feed(chunk)
         else:
-            log.warning('invalid XML data %r', marker)
+            parser.close()
+
+        for event, element in parser.read_events():
+            if 'start' == event:
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            # only complete children of the root
+            if 1 != depth:
+                continue
+
+            if 'Marker' == element.tag:
+                name: str = 'Unknown name'
+                time: float = 0
+                for child in element:
+                    if 'Name' == child.tag and child.text is not None:
+                        name = child.text
+                    if 'Time' == child.tag and child.text is not None:
+                        time = _ts_from_time(child.text)
+
+                yield name, time
+            else:
+                log.warning('invalid XML data %r', element)
+            root.remove(element)  # type: ignore
+
+        if not chunk:
+            return
+
+
+def _cover_files(folder: Path) -> list[Path]:
+    return [f for ext in COVER_EXTENSIONS for f in _list_files(folder, ext)]
+
+
+def _image_info(f, end: Optional[int] = None) -> Optional[tuple[str, int, int, int]]:
+    # (mime, width, height, bits per pixel) of the PNG or JPEG at the current
+    # position, from its IHDR or frame header. The image data is skipped, so
+    # this reads a few hundred bytes even for large files.
+    start = f.tell()
+    head = f.read(8)
+    if PNG_SIGNATURE == head:
+        ihdr = f.read(18)
+        if len(ihdr) < 18 or ihdr[4:8] != b'IHDR':
+            return None
+        width, height, bits, color = struct.unpack('>IIBB', ihdr[8:18])
+        # grey, rgb, palette, grey + alpha, rgba
+        channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color, 1)
+        return 'image/png', width, height, bits * channels
+
+    if head[:3] != b'\xff\xd8\xff':
+        return None
+
+    f.seek(start + 2)
+    while end is None or f.tell() < end:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # fill bytes
+        while 0xFF == marker[1]:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        m = marker[1]
+        # restart markers have no length
+        if 0xD0 <= m <= 0xD7 or 0x01 == m:
+            continue
+        # end of image or scan data without a frame header before it
+        if m in (0xD9, 0xDA):
+            return None
+
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        (length,) = struct.unpack('>H', header)
+
+        # SOF0 to SOF15, except DHT, JPG and DAC
+        if 0xC0 <= m <= 0xCF and m not in (0xC4, 0xC8, 0xCC):
+            sof = f.read(6)
+            if len(sof) < 6:
+                return None
+            bits, height, width, components = struct.unpack('>BHHB', sof)
+            return 'image/jpeg', width, height, bits * components
+        f.seek(length - 2, os.SEEK_CUR)
+
+    return None
 
-    ret['chapters'] = chapters
+
+def _id3_pictures(fname: Path) -> list[tuple[int, int, tuple[str, int, int, int]]]:
+    # (start, end, image info) of the front cover (or untyped) APIC frames of
+    # the ID3v2 tag. Frames are seeked over, only picture headers are read.
+    ret: list = []
+    with open(fname, 'rb') as f:
+        header = _id3_header(f)
+        if header is None:
+            return ret
+        version, _, end = header
+
+        for _, start, frame_end, unsynchronised in _id3_frames(
+            f, version, end, ('APIC',)
+        ):
+            # would need copying
+            if unsynchronised:
+                continue
+
+            f.seek(start)
+            # encoding, mime, picture type, description, image
+            head = f.read(min(frame_end - start, 1024))
+            mime_end = head.find(b'\0', 1)
+            pos = mime_end + 2
+            if head[:1] in (b'\x01', b'\x02'):
+                while pos + 1 < len(head) and head[pos : pos + 2] != b'\0\0':
+                    pos += 2
+                pos += 2
+            else:
+                pos = head.find(b'\0', pos) + 1
+
+            if 0 < mime_end and 0 < pos <= len(head) and head[mime_end + 1] in (0, 3):
+                f.seek(start + pos)
+                info = _image_info(f, frame_end)
+                if info is not None:
+                    ret.append((start + pos, frame_end, info))
 
     return ret
 
 
-def get_folder_metadata(folder: Path, subchapters: bool):
-    files = _list_files(Path(folder), 'mp3')
+def _cover(
+    folder: Path,
+    mp3: Optional[Path] = None,
+    cover_size: Optional[int] = None,
+    cache: bool = True,
+) -> Optional[Path]:
+    # The images in the folder and the pictures in the ID3 tag of the first
+    # part compete by pixels, then by bytes, so a large thumbnail loses to a
+    # small but sharper cover. Embedded pictures and covers over cover_size
+    # pixels on their longest side are written once to the cover cache, or
+    # without the cache to a temporary file removed at exit.
+    candidates = []
+    for f in _cover_files(folder):
+        with open(f, 'rb') as fp:
+            info = _image_info(fp)
+        if info is None:
+            log.warning('Could not read the dimensions of %s', f)
+        pixels = 0 if info is None else info[1] * info[2]
+        # the folder wins over the tag when they are the same
+        candidates.append(((pixels, f.stat().st_size, 1), f, None, info))
+
+    if mp3 is not None:
+        for start, end, info in _id3_pictures(mp3):
+            candidates.append(
+                ((info[1] * info[2], end - start, 0), mp3, (start, end), info)
+            )
+
+    if not candidates:
+        return None
+
+    _, source, span, info = max(candidates, key=lambda c: c[0])
+    log.debug('Cover %s %r %r', source, span, info)
+
+    scale = (
+        cover_size is not None
+        and info is not None
+        and max(info[1], info[2]) > cover_size
+    )
+    if span is None and not scale:
+        return source
+
+    suffix = '.png' if not scale and 'image/png' == info[0] else '.jpg'
+    if cache:
+        key = f'{_file_key(source)}:{span}:{cover_size if scale else None}'
+        target = _cache_dir('cover') / (
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + suffix
+        )
+        if target.exists():
+            # eviction is by least recently used, so touch it
+            with contextlib.suppress(OSError):
+                os.utime(target)
+            log.debug('Cache hit %r', target)
+            return target
+        directory = target.parent
+        directory.mkdir(exist_ok=True, parents=True)
+    else:
+        directory = Path(tempfile.gettempdir())
+
+    with open(source, 'rb') as f:
+        if span is None:
+            data = f.read()
+        else:
+            f.seek(span[0])
+            data = f.read(span[1] - span[0])
 
-    # TODO look at the actual image dimensions and not just file size
-    # just pick the largest image as the correct one
+    with tempfile.NamedTemporaryFile(
+        prefix=f'{APPNAME}.cover.',
+        suffix='.tmp' if cache else suffix,
+        dir=directory,
+        delete=False,
+    ) as f:
+        tmp = Path(f.name)
+        if not scale:
+            f.write(data)
+    if not cache:
+        atexit.register(tmp.unlink, missing_ok=True)
 
     try:
-        image = max((f.stat().st_size, f) for f in _list_files(folder, 'jpg'))[1]
-    except ValueError:
-        image = None
+        if scale:
+            log.info('Downscaling the %dx%d cover of %s', info[1], info[2], folder)
+            subprocess.run(
+                [
+                    'ffmpeg',
+                    '-hide_banner',
+                    '-loglevel',
+                    'error',
+                    '-i',
+                    '-',
+                    '-vf',
+                    f'scale={cover_size}:{cover_size}'
+                    ':force_original_aspect_ratio=decrease:flags=lanczos',
+                    '-frames:v',
+                    '1',
+                    '-q:v',
+                    '3',
+                    '-f',
+                    'mjpeg',
+                    '-y',
+                    tmp,
+                ],
+                input=data,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+        if cache:
+            os.replace(tmp, target)
+    except (OSError, subprocess.CalledProcessError) as e:
+        tmp.unlink(missing_ok=True)
+        log.warning('Could not write the cover of %s: %s', folder, e)
+        # the original is still a usable cover if it is a file of its own
+        return source if span is None else None
+
+    if not cache:
+        return tmp
+    _cache_evict('cover', COVER_CACHE_SIZE, '*.??g')
+    return target
+
+
+def get_folder_metadata(
+    folder: Path,
+    subchapters: bool,
+    probe_jobs: Optional[int] = None,
+    cache: bool = True,
+    cover_size: Optional[int] = None,
+):
+    folder = Path(folder)
+    files = _list_files(folder, 'mp3')
 
     ret: dict = {}
 
-    files_meta = [get_metadata(f) for f in files]
+    # probing is mostly waiting on ffprobe, so run them all at once
+    # map keeps the file order and re-raises the first error like the plain loop
+    _get = partial(get_metadata, cache=cache)
+    if probe_jobs is not None and probe_jobs <= 1:
+        files_meta = [_get(f) for f in files]
+    else:
+        with ThreadPoolExecutor(max_workers=probe_jobs) as executor:
+            files_meta = list(executor.map(_get, files))
+
+    if cache:
+        _cache_evict('metadata', METADATA_CACHE_SIZE)
 
     # order by track number
     files_meta.sort(key=lambda f: int(f['track']))
 
+    image = _cover(
+        folder, Path(files_meta[0]['file']) if files_meta else None, cover_size, cache
+    )
+
     # now get the chapter information
 
     chapters = []
@@ -228,7 +945,8 @@ def get_folder_metadata(folder: Path, subchapters: bool):
 
     prev_name = None
     for f in files_meta:
-        for name, time in f['chapters']:
+        # merged, they are not needed per part any more
+        for name, time in f.pop('chapters'):
             if not subchapters:
                 # cleanup spurious sub chapters
                 if len(name) and name[0].isspace():
@@ -247,7 +965,6 @@ def get_folder_metadata(folder: Path, subchapters: bool):
 
         delta += f['duration']
 
-    ret['files'] = files_meta
     ret['chapters'] = chapters
     ret['duration'] = delta
 
@@ -278,262 +995,3107 @@ def get_folder_metadata(folder: Path, subchapters: bool):
     for field in ('artist', 'genre', 'comment', 'publisher', 'copyright'):
         ret[field] = _get_field(field)
 
+    # the tags of every part are merged by now, only these are used per part
+    ret['files'] = [
+        {
+            k: f[k]
+            for k in ('file', 'track', 'duration', 'sample_rate', 'channels')
+            if k in f
+        }
+        for f in files_meta
+    ]
+
     log.debug('Folder metadata for %r = %r', folder, ret)
     return ret
 
 
-def encode(
-    folder: Path,
-    opus: Optional[Path] = None,
-    bitrate: float = 15,
-    subchapters: bool = False,
-    af: str | None = None,
-    progress: bool = True,
-    speed: int = 0,
-    normalize: Optional[int] = None,
-    isolate_voice: bool = False,
-) -> None:
-    if speed < -99:
-        log.warning('Invalid speed: truncating to -99%')
-        speed = -50
-    speed_float = 1 + speed / 100.0
+OGG_CRC_REVERSE = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+OGG_MAX_PAGE_SAMPLES = 48000
 
-    folder = Path(folder)
-    if opus is None:
-        log.warning('Guessing opus filename')
-        opus = folder.with_suffix('.opus')
+OPUS_FRAME_SAMPLES = (
+    # SILK
+    (480, 960, 1920, 2880),
+    # Hybrid
+    (480, 960),
+    # CELT
+    (120, 240, 480, 960),
+)
 
-    log.info('Encoding from %s to %s', folder, opus)
 
-    metadata = get_folder_metadata(folder, subchapters)
+class OggPage(NamedTuple):
+    flags: int
+    granule: int
+    serial: int
+    sequence: int
+    lacing: bytes
+    body: bytes
+    # as read, it is computed when writing
+    crc: Optional[int] = None
 
-    if 0 == len(metadata['files']):
-        log.error('No mp3 files found. Nothing to encode')
-        raise FileNotFoundError
 
-    opus_params: list[str | bytes] = [
-        'opusenc',
-        '--quiet',
-        '--ignorelength',
-        '--framesize',
-        '60',
-        '--downmix-mono',
-        '--comp',
-        '10',
-        '--vbr',
-        '--bitrate',
-        str(bitrate),
-        '--speech',  # override detection
-        '--title',
-        _str2bytes(metadata['title']),
-        '--artist',
-        _str2bytes(metadata['artist']),
-        '--album',
-        _str2bytes(metadata['album']),
-        '--genre',
-        _str2bytes(metadata['genre']),
-    ]
+def _ogg_crc(data: bytes) -> int:
+    # the Ogg CRC is the non reflected variant of CRC-32 with no init/xor, which
+    # zlib can compute on bit reversed input
+    crc = zlib.crc32(data.translate(OGG_CRC_REVERSE), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f'{crc:032b}'[::-1], 2)
 
-    def _add_comment(k, s):
-        # TODO Do I need to escape = or space?
-        opus_params.extend(['--comment', _str2bytes(f"{k}={metadata[s]}")])
 
-    _add_comment('description', 'comment')
-    _add_comment('publisher', 'publisher')
-    _add_comment('copyright', 'copyright')
+def _ogg_read_pages(f) -> Iterator[OggPage]:
+    while True:
+        header = f.read(27)
+        if not header:
+            return
+        if len(header) < 27 or header[:4] != b'OggS':
+            raise ValueError('Invalid Ogg page at offset %d' % (f.tell() - len(header)))
 
-    for chapter_n, (name, time) in enumerate(metadata['chapters'], start=1):
-        opus_params.extend(
-            ['--comment', ('CHAPTER%02d=' % chapter_n) + _time2str(time / speed_float)]
+        _, flags, granule, serial, sequence, crc, segments = struct.unpack(
+            '<BBqIIIB', header[4:]
         )
-        opus_params.extend(
-            ['--comment', _str2bytes('CHAPTER%02dNAME=%s' % (chapter_n, name))]
+        lacing = f.read(segments)
+        body = f.read(sum(lacing))
+        yield OggPage(flags, granule, serial, sequence, lacing, body, crc)
+
+
+def _ogg_page_bytes(page: OggPage) -> bytes:
+    data = (
+        struct.pack(
+            '<4sBBqIIIB',
+            b'OggS',
+            0,
+            page.flags,
+            page.granule,
+            page.serial,
+            page.sequence,
+            0,
+            len(page.lacing),
         )
+        + page.lacing
+        + page.body
+    )
+    return data[:22] + struct.pack('<I', _ogg_crc(data)) + data[26:]
 
-    image = metadata['image']
-    if image is not None:
-        opus_params.extend(['--picture', image])
 
-    opus_params.extend(['-', str(opus)])
+def _ogg_crc_of(page: OggPage) -> int:
+    (crc,) = struct.unpack_from('<I', _ogg_page_bytes(page), 22)
+    return crc
 
-    log.debug('opusenc = %r', opus_params)
 
-    ffmpeg_params = [
-        'ffmpeg',
-        '-loglevel',
-        'quiet',
-        '-hide_banner',
-        '-stats',
-        '-stats_period',
-        '1',
-    ]
+def _ogg_packets(pages: Iterable[OggPage]) -> Iterator[tuple[bytes, OggPage]]:
+    # yields every packet with the page it ends in
+    partial: list[bytes] = []
+    for page in pages:
+        pos = 0
+        for lace in page.lacing:
+            partial.append(page.body[pos : pos + lace])
+            pos += lace
+            if lace < 255:
+                yield b''.join(partial), page
+                partial = []
 
-    filt = ''
-    for n, f in enumerate(metadata['files']):
-        log.debug('Appending file %r to input', f)
-        ffmpeg_params.extend(['-i', f['file']])
-        filt += f"[{n}:a]"
 
-    # now for the complex filter
-    filt += f"concat=n={n+1}:v=0:a=1"
+class OggWriter:
+    def __init__(self, f, serial: int, sequence: int = 0):
+        self.f = f
+        self.serial = serial
+        self.sequence = sequence
+        self.lacing = bytearray()
+        self.body = bytearray()
+        self.granule = -1
+        self.continued = False
 
-    if isolate_voice:
-        noise_filename = _get_noise_model()
-        filt += f',arnndn=m={noise_filename}'
+    def flush(self, eos: bool = False) -> None:
+        flags = 0x01 if self.continued else 0
+        if 0 == self.sequence:
+            flags |= 0x02
+        if eos:
+            flags |= 0x04
 
-    if normalize is not None:
-        if normalize > 100:
-            normalize = 100
-        elif normalize < 0:
-            normalize = 0
+        page = OggPage(
+            flags,
+            self.granule,
+            self.serial,
+            self.sequence,
+            bytes(self.lacing),
+            bytes(self.body),
+        )
+        self.f.write(_ogg_page_bytes(page))
 
-        # "widest" parameters possible
-        audio_peak = normalize / 100.0
-        audio_framelen = 8000
-        audio_gausssize = 301
-        audio_correctdc = 1
+        self.sequence += 1
+        self.lacing.clear()
+        self.body.clear()
+        self.granule = -1
+        self.continued = False
 
-        filt += f',dynaudnorm=peak={audio_peak}:framelen={audio_framelen}:gausssize={audio_gausssize}:correctdc={audio_correctdc}'
+    def write(
+        self, packet: bytes, granule: int, flush: bool = False, eos: bool = False
+    ) -> None:
+        pos = 0
+        while True:
+            if 255 == len(self.lacing):
+                self.flush()
+                # only if the packet goes on in the next page
+                self.continued = pos > 0
+            lace = min(255, len(packet) - pos)
+            self.lacing.append(lace)
+            self.body += packet[pos : pos + lace]
+            pos += lace
+            if lace < 255:
+                break
 
-    if 0 != speed:
-        log.info('Adding speedup filter %r', speed_float)
-        filt += ',atempo=%f' % (speed_float,)
+        self.granule = granule
+        if flush or eos:
+            self.flush(eos)
 
-    if af is not None:
-        log.info('Adding filter %r', af)
-        filt += ',' + af
 
-    ffmpeg_params.extend(
-        ['-filter_complex', filt, '-f', 'wav', '-acodec', 'pcm_s16le', '-']
-    )
+def _opus_samples(packet: bytes) -> int:
+    toc = packet[0]
+    config = toc >> 3
 
-    log.debug('ffmpeg_params = %r', ffmpeg_params)
+    if config < 12:
+        frame = OPUS_FRAME_SAMPLES[0][config % 4]
+    elif config < 16:
+        frame = OPUS_FRAME_SAMPLES[1][config % 2]
+    else:
+        frame = OPUS_FRAME_SAMPLES[2][config % 4]
 
-    log.info('%s files (%s)', len(metadata['files']), _time2str(metadata['duration']))
+    code = toc & 0x03
+    if 0 == code:
+        return frame
+    elif 3 == code:
+        return frame * (packet[1] & 0x3F)
+    return frame * 2
 
-    ffmpeg_sub = subprocess.Popen(
-        ffmpeg_params,
-        stdout=subprocess.PIPE,
-        stdin=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
+
+def _opus_tags_parse(packet: bytes) -> tuple[bytes, list[bytes]]:
+    if packet[:8] != b'OpusTags':
+        raise ValueError('Not an OpusTags packet')
+
+    pos = 8
+    (length,) = struct.unpack_from('<I', packet, pos)
+    vendor = packet[pos + 4 : pos + 4 + length]
+    pos += 4 + length
+
+    (count,) = struct.unpack_from('<I', packet, pos)
+    pos += 4
+    comments = []
+    for _ in range(count):
+        (length,) = struct.unpack_from('<I', packet, pos)
+        comments.append(packet[pos + 4 : pos + 4 + length])
+        pos += 4 + length
+
+    return vendor, comments
+
+
+def _opus_tags_build(vendor: bytes, comments: list[bytes]) -> bytes:
+    ret = [b'OpusTags', struct.pack('<I', len(vendor)), vendor]
+    ret.append(struct.pack('<I', len(comments)))
+    for c in comments:
+        ret.extend((struct.pack('<I', len(c)), c))
+    return b''.join(ret)
+
+
+def _read_opus_tags(opus: Path) -> tuple[bytes, list[bytes]]:
+    # only reads the first pages
+    with open(opus, 'rb') as f:
+        packets = _ogg_packets(_ogg_read_pages(f))
+        head, _ = next(packets)
+        if head[:8] != b'OpusHead':
+            raise ValueError('Not an Ogg Opus file')
+        tags, _ = next(packets)
+    return _opus_tags_parse(tags)
+
+
+def _manifest(folder: Path, params: dict) -> str:
+    # Everything that ends up in the output: the mp3 parts and cover
+    # candidates (by name, size and mtime) and the encode parameters
+    inputs = hashlib.sha256()
+    for f in sorted(_list_files(folder, 'mp3') + _cover_files(folder)):
+        st = f.stat()
+        inputs.update(f'{f.name}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode('utf-8'))
+
+    return json.dumps(
+        {'version': MANIFEST_VERSION, 'inputs': inputs.hexdigest(), 'params': params},
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+
+
+def _read_manifest(opus: Path) -> Optional[str]:
+    try:
+        _, comments = _read_opus_tags(opus)
+    except (OSError, ValueError, StopIteration, struct.error):
+        return None
+
+    prefix = (MANIFEST_TAG + '=').encode('ascii')
+    for c in comments:
+        if c.startswith(prefix):
+            return c[len(prefix) :].decode('utf-8', errors='replace')
+    return None
+
+
+def _same_chapters(old: Optional[str], manifest: str) -> bool:
+    # whether old is the manifest of a chapter file split from the same inputs
+    if old is None:
+        return False
+    try:
+        old_manifest = json.loads(old)
+        return bool(old_manifest['params'].get('split_chapters')) and (
+            old_manifest['inputs'] == json.loads(manifest)['inputs']
+        )
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+def _seam_shift(t: float, seams: list[tuple[float, float]]) -> float:
+    # seams are where every segment starts, (expected, actual) in seconds
+    for expected, actual in reversed(seams):
+        if t >= expected:
+            return t + actual - expected
+    return t
+
+
+def _ogg_stitch(segments: list[Path], nominal: list[float], opus: Path) -> float:
+    # Joins independently encoded Opus files into one stream. Headers and tags
+    # come from the first one, audio packets of all of them are paginated
+    # again with continuous granule positions. The encoder padding at the end
+    # of every segment and the decoder warm up (pre-skip) at the start of the
+    # next one stay in, so the chapters after each seam are shifted by the
+    # amount of extra audio. Returns the length of the output in seconds.
+
+    def _packets(segment: Path) -> Iterator[tuple[bytes, OggPage]]:
+        with open(segment, 'rb') as f:
+            yield from _ogg_packets(_ogg_read_pages(f))
+
+    # first pass only counts, so the audio is never held in memory
+    streams = []
+    for segment in segments:
+        packets = _packets(segment)
+        head, head_page = next(packets)
+        tags, _ = next(packets)
+        samples = 0
+        granule = 0
+        for packet, page in packets:
+            samples += _opus_samples(packet)
+            granule = page.granule
+        pre_skip = struct.unpack_from('<H', head, 10)[0]
+        streams.append((head, head_page.serial, tags, samples, granule, pre_skip))
+
+    head, serial, tags, _, _, pre_skip = streams[0]
+
+    # where every segment starts, in seconds of output
+    actual = [0.0]
+    expected = [0.0]
+    for n, (_, _, _, samples, _, _) in enumerate(streams):
+        if 0 == n:
+            samples -= pre_skip
+        actual.append(actual[-1] + samples / 48000)
+        expected.append(expected[-1] + nominal[n])
+
+    seams = list(zip(expected, actual))[: len(streams)]
+
+    vendor, comments = _opus_tags_parse(tags)
+    rx = re.compile(rb'^(CHAPTER\d+)=(.*)$', re.DOTALL)
+    for n, comment in enumerate(comments):
+        m = rx.match(comment)
+        if m:
+            t = _seam_shift(_ts_from_time(m.group(2).decode('ascii')), seams)
+            comments[n] = m.group(1) + b'=' + _time2str(t).encode('ascii')
+    comments.append(_str2bytes(f'{SEAMS_TAG}={json.dumps(seams)}'))
+    tags = _opus_tags_build(vendor, comments)
+
+    last_samples, last_granule = streams[-1][3:5]
+    end_trim = last_samples - last_granule
+    length = actual[-1] - end_trim / 48000
+
+    with open(opus, 'wb') as f:
+        writer = OggWriter(f, serial)
+        writer.write(head, 0, flush=True)
+        writer.write(tags, 0, flush=True)
+
+        granule = 0
+        page_start = 0
+        total = sum(s[3] for s in streams)
+        for segment in segments:
+            packets = _packets(segment)
+            # skip the headers
+            next(packets)
+            next(packets)
+            for packet, _ in packets:
+                granule += _opus_samples(packet)
+                if granule == total:
+                    writer.write(packet, granule - end_trim, eos=True)
+                elif granule - page_start >= OGG_MAX_PAGE_SAMPLES:
+                    writer.write(packet, granule, flush=True)
+                    page_start = granule
+                else:
+                    writer.write(packet, granule)
+
+    return length
+
+
+def _check_picture(value: str) -> Optional[str]:
+    # a METADATA_BLOCK_PICTURE is a FLAC picture block in base64
+    try:
+        block = base64.b64decode(value, validate=True)
+        pos = 4
+        (length,) = struct.unpack_from('>I', block, pos)
+        mime = block[pos + 4 : pos + 4 + length]
+        pos += 4 + length
+        (length,) = struct.unpack_from('>I', block, pos)
+        pos += 4 + length
+        width, height, _, _, length = struct.unpack_from('>IIIII', block, pos)
+        data = block[pos + 20 :]
+    except (ValueError, struct.error) as e:
+        return f'picture block is invalid: {e}'
+
+    if len(data) != length:
+        return f'picture block has {len(data)} bytes of image, not {length}'
+    magic = {b'image/jpeg': b'\xff\xd8\xff', b'image/png': PNG_SIGNATURE}
+    if mime in magic and not data.startswith(magic[mime]):
+        return f'picture is not {mime.decode()}'
+    # 0 is unknown, opusenc leaves them at that for images it can't read
+    info = _image_info(io.BytesIO(data))
+    if width and info is not None and (width, height) != info[1:3]:
+        return f'picture is {info[1]}x{info[2]}, not {width}x{height}'
+    return None
+
+
+def _check_tags(
+    comments: list[bytes], length: float, chapters: Optional[int]
+) -> list[str]:
+    problems = []
+    starts: dict[int, str] = {}
+    names: dict[int, str] = {}
+    for c in comments:
+        key, _, value = c.decode('utf-8', errors='replace').partition('=')
+        match = re.fullmatch(r'CHAPTER(\d+)(NAME)?', key, re.IGNORECASE)
+        if match is not None:
+            (names if match.group(2) else starts)[int(match.group(1))] = value
+        elif 'METADATA_BLOCK_PICTURE' == key.upper():
+            problem = _check_picture(value)
+            if problem is not None:
+                problems.append(problem)
+
+    numbers = sorted(set(starts) | set(names))
+    if numbers != list(range(1, len(numbers) + 1)):
+        problems.append(f'chapters are not numbered 1 to {len(numbers)}')
+    for n in numbers:
+        if n not in starts or n not in names:
+            problems.append(f'chapter {n} has no start or no name')
+
+    previous = 0.0
+    for n, value in sorted(starts.items()):
+        try:
+            start = _ts_from_time(value)
+        except ValueError:
+            problems.append(f'chapter {n} starts at {value!r}')
+            continue
+        if start < previous:
+            problems.append(f'chapter {n} starts at {value}, out of order')
+        elif start > length:
+            problems.append(f'chapter {n} starts at {value}, after the end')
+        previous = start
+
+    if chapters is not None and len(numbers) != chapters:
+        problems.append(f'{len(numbers)} chapters, expected {chapters}')
+    return problems
+
+
+def verify_opus(
+    opus: Path,
+    duration: Optional[float] = None,
+    chapters: Optional[int] = None,
+    picture: Optional[bool] = None,
+) -> list[str]:
+    # Walks the Ogg pages without decoding any audio, so it costs no more
+    # than reading the file, and returns what is wrong with it: CRCs, page
+    # order, granule positions against the packets, the expected duration
+    # (seconds), number of chapters and presence of a cover.
+    problems: list[str] = []
+    state = {'samples': 0, 'pages': 0, 'serial': None}
+    head = tags = None
+
+    def _granule(page: OggPage, final: bool) -> None:
+        # all packets ending in the page are counted by now
+        samples = state['samples']
+        if -1 == page.granule:
+            return
+        if final and page.granule <= samples < page.granule + 5760:
+            return
+        if page.granule != samples:
+            problems.append(
+                f'page {page.sequence} has granule {page.granule}, '
+                f'its packets end at {samples}'
+            )
+
+    def _checked(pages: Iterator[OggPage]) -> Iterator[OggPage]:
+        previous = None
+        for page in pages:
+            if previous is not None:
+                _granule(previous, False)
+
+            n = state['pages']
+            if len(page.body) != sum(page.lacing):
+                problems.append(f'page {n} is truncated')
+                return
+            if _ogg_crc_of(page) != page.crc:
+                problems.append(f'page {n} has a bad CRC')
+            if state['serial'] is None:
+                state['serial'] = page.serial
+            elif page.serial != state['serial']:
+                problems.append(f'page {n} belongs to another stream')
+            if page.sequence != n:
+                problems.append(f'page {n} has sequence number {page.sequence}')
+            if bool(page.flags & 0x02) != (0 == n):
+                problems.append(f'page {n} has a wrong beginning of stream flag')
+            if previous is not None and previous.flags & 0x04:
+                problems.append(f'page {n} is after the end of stream')
+            continued = previous is not None and previous.lacing[-1:] == b'\xff'
+            if bool(page.flags & 0x01) != continued:
+                problems.append(f'page {n} has a wrong continuation flag')
+
+            state['pages'] += 1
+            yield page
+            previous = page
+
+        if previous is None:
+            problems.append('no Ogg pages')
+            return
+        _granule(previous, True)
+        if not previous.flags & 0x04:
+            problems.append('the last page has no end of stream flag')
+        state['granule'] = previous.granule
+
+    try:
+        with open(opus, 'rb') as f:
+            for n, (packet, _) in enumerate(_ogg_packets(_checked(_ogg_read_pages(f)))):
+                if 0 == n:
+                    head = packet
+                elif 1 == n:
+                    tags = packet
+                elif packet:
+                    state['samples'] += _opus_samples(packet)
+    except (ValueError, struct.error, IndexError) as e:
+        problems.append(str(e))
+        return problems
+
+    if head is None or head[:8] != b'OpusHead' or len(head) < 19:
+        problems.append('no OpusHead')
+        return problems
+    # unknown if the stream ended early
+    length = math.inf
+    if 'granule' in state:
+        (preskip,) = struct.unpack_from('<H', head, 10)
+        length = (state['granule'] - preskip) / 48000
+    if (
+        duration is not None
+        and length < math.inf
+        and abs(length - duration) > VERIFY_TOLERANCE
+    ):
+        problems.append(f'{_time2str(length)} of audio, expected {_time2str(duration)}')
+
+    try:
+        _, comments = _opus_tags_parse(tags or b'')
+    except (ValueError, struct.error) as e:
+        problems.append(f'OpusTags: {e}')
+        return problems
+    problems.extend(_check_tags(comments, length, chapters))
+
+    if picture is not None:
+        pictures = sum(c[:23].upper() == b'METADATA_BLOCK_PICTURE=' for c in comments)
+        if pictures != int(picture):
+            problems.append(f'{pictures} pictures, expected {int(picture)}')
+
+    return problems
+
+
+def _verify_outputs(outputs: dict[Path, dict]) -> dict[str, list[str]]:
+    # verify_opus every output against what is expected of it
+    ret = {}
+    for output, expected in outputs.items():
+        problems = verify_opus(output, **expected)
+        for problem in problems:
+            log.error('%s: %s', output, problem)
+        if problems:
+            ret[str(output)] = problems
+        else:
+            log.info('%s verified', output)
+    return ret
+
+
+class _ProgressBar:
+    def __init__(self, title: str, total: float, enabled: bool = True):
+        self.title = title
+        self.total = total
+        self.enabled = enabled
+        self.started = False
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        from rich.progress import BarColumn, Column, Progress, TextColumn
+        from rich.progress import TimeRemainingColumn
+
+        self.status = TextColumn('')
+        self.stats = TextColumn('')
+        self.bar = Progress(
+            TextColumn(
+                f"[bold blue]{self.title}",
+                justify="right",
+                table_column=Column(ratio=1),
+            ),
+            BarColumn(bar_width=None, table_column=Column(ratio=2)),
+            "[progress.percentage]{task.percentage:>3.0f}%",
+            self.status,
+            self.stats,
+            TimeRemainingColumn(),
+        )
+        self.bar.__enter__()
+        self.task = self.bar.add_task('Encoding', total=self.total, start=False)
+        self.status.text_format = "[bold]Processing"
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.bar.__exit__(*exc)
+
+    def update(self, progress: dict) -> None:
+        completed = progress.get('out_time')
+        if not self.enabled or not completed:
+            return
+        if not self.started:
+            self.status.text_format = "[bold cyan]Encoding"
+            self.bar.start_task(self.task)
+            self.started = True
+
+        stats = []
+        if progress.get('speed'):
+            stats.append('%.1fx' % progress['speed'])
+        if progress.get('bitrate'):
+            stats.append('%.1f kbit/s' % progress['bitrate'])
+        self.stats.text_format = ' '.join(stats)
+
+        self.bar.update(self.task, completed=completed)
+
+    def done(self, ok: bool) -> None:
+        if not self.enabled:
+            return
+        if ok:
+            self.status.text_format = "[bold green]:thumbs_up:"
+        else:
+            self.status.text_format = "[bold blink red]:thumbs_down:"
+
+
+def _opus_params(
+    metadata: dict,
+    bitrate: float,
+    speed_float: float,
+    tags: bool = True,
+    raw_rate: Optional[int] = None,
+    manifest: Optional[str] = None,
+    framesize: int = 60,
+) -> list[str | bytes]:
+    opus_params: list[str | bytes] = ['opusenc', '--quiet']
+
+    if raw_rate is None:
+        opus_params.extend(['--ignorelength', '--downmix-mono'])
+    else:
+        opus_params.extend(
+            [
+                '--raw',
+                '--raw-bits',
+                '16',
+                '--raw-rate',
+                str(raw_rate),
+                '--raw-chan',
+                '1',
+                '--raw-endianness',
+                '0',
+            ]
+        )
+
+    opus_params += [
+        '--framesize',
+        str(framesize),
+        '--comp',
+        '10',
+        '--vbr',
+        '--bitrate',
+        str(bitrate),
+        '--speech',  # override detection
+    ]
+
+    if not tags:
+        return opus_params
+
+    opus_params.extend(
+        [
+            '--title',
+            _str2bytes(metadata['title']),
+            '--artist',
+            _str2bytes(metadata['artist']),
+            '--album',
+            _str2bytes(metadata['album']),
+            '--genre',
+            _str2bytes(metadata['genre']),
+        ]
+    )
+
+    def _add_comment(k, s):
+        # TODO Do I need to escape = or space?
+        opus_params.extend(['--comment', _str2bytes(f"{k}={metadata[s]}")])
+
+    _add_comment('description', 'comment')
+    _add_comment('publisher', 'publisher')
+    _add_comment('copyright', 'copyright')
+    if 'tracknumber' in metadata:
+        _add_comment('tracknumber', 'tracknumber')
+        _add_comment('tracktotal', 'tracktotal')
+
+    for chapter_n, (name, time) in enumerate(metadata['chapters'], start=1):
+        opus_params.extend(
+            ['--comment', ('CHAPTER%02d=' % chapter_n) + _time2str(time / speed_float)]
+        )
+        opus_params.extend(
+            ['--comment', _str2bytes('CHAPTER%02dNAME=%s' % (chapter_n, name))]
+        )
+
+    if manifest is not None:
+        opus_params.extend(['--comment', _str2bytes(f'{MANIFEST_TAG}={manifest}')])
+
+    image = metadata['image']
+    if image is not None:
+        opus_params.extend(['--picture', image])
+
+    return opus_params
+
+
+def _get_loudness(fname: Path, filters: Sequence[str] = ()) -> dict:
+    # EBU R128 measurement of the mono downmix, which is what gets encoded,
+    # after the filters that come before the gain (voice isolation). In s16
+    # like the PCM pipe, the downmix is only scaled for integer formats.
+    process = subprocess.run(
+        [
+            'ffmpeg',
+            '-hide_banner',
+            '-nostats',
+            '-i',
+            fname,
+            '-af',
+            ','.join(
+                list(filters)
+                + [
+                    'aformat=sample_fmts=s16:channel_layouts=mono',
+                    'loudnorm=print_format=json',
+                ]
+            ),
+            '-f',
+            'null',
+            '-',
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    # the JSON block is the last thing loudnorm logs
+    stderr = process.stderr.decode('utf-8', errors='replace')
+    stats = json.loads(stderr[stderr.rindex('{') : stderr.rindex('}') + 1])
+    log.debug('loudness of %r: %r', fname, stats)
+
+    return {
+        'integrated': float(stats['input_i']),
+        'true_peak': float(stats['input_tp']),
+        'range': float(stats['input_lra']),
+    }
+
+
+def _cached(
+    kind: str,
+    get: Callable,
+    fname: Path,
+    cache: bool = True,
+    variant: Optional[str] = None,
+):
+    # per mp3 analysis, reused for as long as the file is unchanged. A variant
+    # tells apart analyses of the same file with different options.
+    if not cache:
+        return get(fname)
+
+    key = _file_key(fname)
+    if variant:
+        key = hashlib.sha1(f'{key}:{variant}'.encode('utf-8')).hexdigest()
+    ret = _cache_load(kind, key)
+    if ret is not None:
+        return ret
+
+    ret = get(fname)
+    _cache_store(kind, key, ret)
+    return ret
+
+
+def _pcm_cache_entry(
+    files: list[dict], filters: list[str], voice: Optional[tuple] = None
+) -> Path:
+    # the audio is a function of the parts (and where they are cut), the
+    # filters and, when chunked, how voice isolation was done
+    key = json.dumps(
+        [
+            [
+                [_file_key(Path(f['file'])), f.get('inpoint'), f.get('outpoint')]
+                for f in files
+            ],
+            filters,
+            voice,
+        ]
+    )
+    return _cache_dir('pcm') / (hashlib.sha1(key.encode('utf-8')).hexdigest() + '.flac')
+
+
+def _loudnorm_gain(
+    files: list[dict],
+    target: float,
+    cache: bool = True,
+    filters: Sequence[str] = (),
+) -> float:
+    # first pass, every part is measured on its own so they can run in
+    # parallel and be reused when only the encoding options change. filters
+    # are the ones applied before the gain, they change the loudness.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        parts = list(
+            executor.map(
+                partial(
+                    _cached,
+                    'loudness',
+                    partial(_get_loudness, filters=filters),
+                    cache=cache,
+                    variant=','.join(filters),
+                ),
+                [f['file'] for f in files],
+            )
+        )
+
+    if cache:
+        _cache_evict('loudness', LOUDNESS_CACHE_SIZE)
+
+    # Integrated loudness is gated over the whole programme, the duration
+    # weighted mean energy of the parts is very close for a book
+    energy = 0.0
+    for f, part in zip(files, parts):
+        if part['integrated'] > -math.inf:
+            energy += f['duration'] * 10 ** (part['integrated'] / 10)
+    if 0 == energy:
+        log.warning('Book is silent, not normalizing')
+        return 0.0
+    integrated = 10 * math.log10(energy / sum(f['duration'] for f in files))
+    true_peak = max(part['true_peak'] for part in parts)
+
+    gain = min(target - integrated, LOUDNORM_TRUE_PEAK - true_peak)
+    log.info(
+        'Loudness %.1f LUFS, true peak %.1f dBTP: gain %+.1f dB',
+        integrated,
+        true_peak,
+        gain,
+    )
+    return gain
+
+
+def _get_silences(fname: Path) -> list[list[float]]:
+    # pauses as [start, end], in seconds from the first decoded sample
+    process = subprocess.run(
+        [
+            'ffmpeg',
+            '-hide_banner',
+            '-nostats',
+            '-i',
+            fname,
+            '-vn',
+            '-af',
+            'asetpts=PTS-STARTPTS,'
+            f'silencedetect=n={SILENCE_NOISE}dB:d={SILENCE_DURATION}',
+            '-f',
+            'null',
+            '-',
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    ret = []
+    start = None
+    for line in process.stderr.decode('utf-8', errors='replace').splitlines():
+        m = re.search(r'silence_(start|end): (-?[0-9.]+)', line)
+        if m is None:
+            continue
+        if 'start' == m.group(1):
+            start = max(0.0, float(m.group(2)))
+        elif start is not None:
+            ret.append([start, float(m.group(2))])
+            start = None
+
+    log.debug('%d silences in %r', len(ret), fname)
+    return ret
+
+
+def _split_points(files: list[dict], cache: bool = True) -> list[float]:
+    # where the book is best cut: the middle of every pause and the part
+    # boundaries, in seconds from its start
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        silences = list(
+            executor.map(
+                partial(_cached, 'silence', _get_silences, cache=cache),
+                [f['file'] for f in files],
+            )
+        )
+
+    if cache:
+        _cache_evict('silence', SILENCE_CACHE_SIZE)
+
+    points = []
+    offset = 0.0
+    for f, part in zip(files, silences):
+        points.append(offset)
+        points.extend(offset + (start + end) / 2 for start, end in part)
+        offset += f['duration']
+    points.append(offset)
+
+    return sorted(points)
+
+
+def _snap(t: float, points: Sequence[float], tolerance: float) -> float:
+    # the preferred point nearest to t, if there is one close enough
+    n = bisect_left(points, t)
+    near = [p for p in points[max(0, n - 1) : n + 1] if abs(p - t) <= tolerance]
+    return min(near, key=lambda p: abs(p - t)) if near else t
+
+
+def _filters(
+    speed: int,
+    normalize: Optional[int] = None,
+    isolate_voice: bool = False,
+    af: str | None = None,
+    gain: Optional[float] = None,
+) -> list[str]:
+    filters = []
+
+    if isolate_voice:
+        noise_filename = _get_noise_model()
+        filters.append(f'arnndn=m={noise_filename}')
+
+    if gain is not None:
+        filters.append(f'volume={gain:.2f}dB')
+
+    if normalize is not None:
+        if normalize > 100:
+            normalize = 100
+        elif normalize < 0:
+            normalize = 0
+
+        # "widest" parameters possible
+        audio_peak = normalize / 100.0
+        audio_framelen = 8000
+        audio_gausssize = 301
+        audio_correctdc = 1
+
+        filters.append(
+            f'dynaudnorm=peak={audio_peak}:framelen={audio_framelen}:gausssize={audio_gausssize}:correctdc={audio_correctdc}'
+        )
+
+    if 0 != speed:
+        speed_float = 1 + speed / 100.0
+        log.info('Adding speedup filter %r', speed_float)
+        filters.append('atempo=%f' % (speed_float,))
+
+    if af is not None:
+        log.info('Adding filter %r', af)
+        filters.append(af)
+
+    return filters
+
+
+def _opus_comments(
+    metadata: dict, speed_float: float, manifest: Optional[str] = None
+) -> list[tuple[str, str]]:
+    # same tags opusenc writes, for the ffmpeg backend and retagging
+    tags = [
+        ('title', metadata['title']),
+        ('artist', metadata['artist']),
+        ('album', metadata['album']),
+        ('genre', metadata['genre']),
+        ('description', metadata['comment']),
+        ('publisher', metadata['publisher']),
+        ('copyright', metadata['copyright']),
+    ]
+    if 'tracknumber' in metadata:
+        tags.append(('tracknumber', metadata['tracknumber']))
+        tags.append(('tracktotal', metadata['tracktotal']))
+
+    for chapter_n, (name, start) in enumerate(metadata['chapters'], start=1):
+        tags.append(('CHAPTER%02d' % chapter_n, _time2str(start / speed_float)))
+        tags.append(('CHAPTER%02dNAME' % chapter_n, name))
+
+    if manifest is not None:
+        tags.append((MANIFEST_TAG, manifest))
+
+    image = metadata['image']
+    if image is not None:
+        tags.append(('METADATA_BLOCK_PICTURE', _picture_block(image)))
+
+    return tags
+
+
+def _ffmetadata(
+    metadata: dict, speed_float: float, manifest: Optional[str] = None
+) -> str:
+    def _escape(s: str) -> str:
+        return re.sub(r'([=;#\\\n])', r'\\\1', str(s))
+
+    return ';FFMETADATA1\n' + ''.join(
+        f'{k}={_escape(v)}\n'
+        for k, v in _opus_comments(metadata, speed_float, manifest)
+    )
+
+
+def _picture_block(image: Path) -> str:
+    # FLAC picture block, front cover, the way opusenc embeds --picture
+    with open(image, 'rb') as f:
+        info = _image_info(f)
+        f.seek(0)
+        data = f.read()
+    if info is None:
+        mime, width, height, depth = 'image/jpeg', 0, 0, 0
+    else:
+        mime, width, height, depth = info
+    block = b''.join(
+        [
+            struct.pack('>II', 3, len(mime)),
+            mime.encode('ascii'),
+            # description, colors (not indexed)
+            struct.pack('>IIIIII', 0, width, height, depth, 0, len(data)),
+            data,
+        ]
+    )
+    return base64.b64encode(block).decode('ascii')
+
+
+def _pcm_output(raw_rate: Optional[int] = None) -> list[str]:
+    if raw_rate is None:
+        return ['-f', 'wav', '-acodec', 'pcm_s16le', '-']
+
+    # downmix and resample here, opusenc gets exactly what it encodes
+    return [
+        '-ac',
+        '1',
+        '-ar',
+        str(raw_rate),
+        '-f',
+        's16le',
+        '-acodec',
+        'pcm_s16le',
+        '-',
+    ]
+
+
+def _libopus_output(
+    bitrate: float,
+    raw_rate: Optional[int],
+    opus: Path,
+    tags_input: Optional[int] = None,
+    framesize: int = 60,
+) -> list[str]:
+    # mirrors the opusenc options, s16 keeps the downmix level of the PCM pipe.
+    # ffmpeg has no signal type option, so unlike opusenc --speech libopus
+    # detects speech on its own. voip would change the encoding, not hint it.
+    ffmpeg_params = [
+        '-ac',
+        '1',
+        '-ar',
+        str(raw_rate or 48000),
+        '-sample_fmt',
+        's16',
+        '-c:a',
+        'libopus',
+        '-b:a',
+        f'{bitrate}k',
+        '-vbr',
+        'on',
+        '-compression_level',
+        '10',
+        '-frame_duration',
+        str(framesize),
+        '-application',
+        'audio',
+    ]
+
+    # never copy the mp3 tags, OverDrive markers would end up in the output
+    if tags_input is None:
+        ffmpeg_params.extend(['-map_metadata', '-1'])
+    else:
+        ffmpeg_params.extend(['-map_metadata', str(tags_input)])
+
+    ffmpeg_params.extend(['-map_chapters', '-1', '-f', 'opus', '-y', str(opus)])
+    return ffmpeg_params
+
+
+def _concat_list(files: list[dict]) -> Optional[str]:
+    # The concat demuxer decodes the parts one after the other with a single
+    # decoder, but only works if they all have the same audio parameters
+    # its inpoint/outpoint are not sample exact, unlike seeking with -ss/-to
+    if any(f.get('inpoint') or f.get('outpoint') is not None for f in files):
+        return None
+
+    params = {(f.get('sample_rate'), f.get('channels')) for f in files}
+    if 1 != len(params) or None in next(iter(params)):
+        log.info('mp3 parts differ (%r), using the concat filter', params)
+        return None
+
+    def _quote(f: Path) -> str:
+        return "'" + str(Path(f).absolute()).replace("'", "'\\''") + "'"
+
+    return ''.join(f"file {_quote(f['file'])}\n" for f in files)
+
+
+def _ffmpeg_params(
+    files: list[dict],
+    filters: list[str],
+    output: list[str],
+    extra_inputs: Iterable[Path] = (),
+    concat: Optional[Path] = None,
+    progress: bool = True,
+    raw_input: Optional[int] = None,
+    tee: Optional[tuple[int, Path]] = None,
+) -> list[str | Path]:
+    ffmpeg_params: list[str | Path] = [
+        'ffmpeg',
+        '-loglevel',
+        'quiet',
+        '-hide_banner',
+        '-nostats',
+    ]
+
+    if progress:
+        # machine readable key=value blocks on stderr, once a second
+        ffmpeg_params.extend(['-progress', 'pipe:2', '-stats_period', '1'])
+
+    if raw_input is not None:
+        # mono PCM on stdin, files only say what it was made from
+        ffmpeg_params.extend(
+            ['-f', 's16le', '-ar', str(raw_input), '-ac', '1', '-i', '-']
+        )
+        filt = '[0:a]anull'
+        n = 0
+    elif concat is not None:
+        log.debug('Using concat list %r', concat)
+        ffmpeg_params.extend(['-f', 'concat', '-safe', '0', '-i', concat])
+        filt = '[0:a]anull'
+        n = 0
+    else:
+        filt = ''
+        for n, f in enumerate(files):
+            log.debug('Appending file %r to input', f)
+            if f.get('inpoint'):
+                ffmpeg_params.extend(['-ss', f'{f["inpoint"]:.6f}'])
+            if f.get('outpoint') is not None:
+                ffmpeg_params.extend(['-to', f'{f["outpoint"]:.6f}'])
+            ffmpeg_params.extend(['-i', f['file']])
+            filt += f"[{n}:a]"
+
+        # now for the complex filter
+        filt += f"concat=n={n+1}:v=0:a=1"
+
+    for extra in extra_inputs:
+        ffmpeg_params.extend(['-i', extra])
+
+    if tee is None:
+        for f in filters:
+            filt += ',' + f
+
+        ffmpeg_params.extend(['-filter_complex', filt])
+        ffmpeg_params.extend(output)
+    else:
+        # the audio after the first n filters is also written to a FLAC file
+        n, flac = tee
+        for f in filters[:n]:
+            filt += ',' + f
+        filt += ',asplit=2[tee][rest];[rest]' + ','.join(['anull'] + filters[n:])
+
+        ffmpeg_params.extend(['-filter_complex', filt + '[out]', '-map', '[out]'])
+        ffmpeg_params.extend(output)
+        ffmpeg_params.extend(
+            [
+                '-map',
+                '[tee]',
+                '-ac',
+                '1',
+                '-sample_fmt',
+                's16',
+                '-c:a',
+                'flac',
+                '-f',
+                'flac',
+                '-y',
+                flac,
+            ]
+        )
+
+    log.debug('ffmpeg_params = %r', ffmpeg_params)
+    return ffmpeg_params
+
+
+def _float(s: Optional[str]) -> Optional[float]:
+    try:
+        return float(s)  # type: ignore
+    except (TypeError, ValueError):
+        return None
+
+
+async def _read_progress(
+    stream: asyncio.StreamReader, on_progress: Callable[[dict], None]
+) -> None:
+    state: dict = {}
+    async for line in stream:
+        key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+
+        # every block ends with progress=continue or progress=end
+        if 'progress' != key:
+            state[key] = value
+            continue
+
+        out_time = _int(state.get('out_time_us'))
+        on_progress(
+            {
+                'out_time': None if out_time is None else out_time / 1e6,
+                'speed': _float(state.get('speed', '').rstrip('x')),
+                'bitrate': _float(state.get('bitrate', '').replace('kbits/s', '')),
+                'total_size': _int(state.get('total_size')),
+                'end': 'end' == value,
+            }
+        )
+
+
+def _wait4(process: subprocess.Popen, start: float) -> dict:
+    # like wait() but keeps the resource usage of the child
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return {
+        'command': Path(process.args[0]).name,  # type: ignore
+        'returncode': process.returncode,
+        'wall': time.perf_counter() - start,
+        'cpu_user': usage.ru_utime,
+        'cpu_sys': usage.ru_stime,
+        'peak_rss_kb': usage.ru_maxrss,
+    }
+
+
+async def _wait4_async(process: subprocess.Popen, start: float) -> dict:
+    # asyncio's own subprocesses are reaped by its child watcher, which drops
+    # the resource usage. A pidfd becomes readable when the child exits, so
+    # the event loop waits for it and _wait4 no longer blocks.
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return await asyncio.to_thread(_wait4, process, start)
+
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return _wait4(process, start)
+
+
+def _kill(process: subprocess.Popen) -> None:
+    # Popen.kill() may reap the process, and _wait4 wants to do that
+    try:
+        os.kill(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _reap(processes: Sequence[subprocess.Popen], start: float) -> None:
+    # on errors and cancellation nothing may keep running, or be left defunct
+    for process in processes:
+        if process.returncode is None:
+            _kill(process)
+            _wait4(process, start)
+
+
+async def _pipe_reader(pipe) -> tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    return reader, transport
+
+
+async def _pipe_writer(pipe) -> asyncio.StreamWriter:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, pipe
+    )
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def _run_pipeline(
+    ffmpeg_params: list,
+    opus_params: Optional[list] = None,
+    on_progress: Optional[Callable[[dict], None]] = None,
+    stats: Optional[dict] = None,
+    feed: Optional[Callable[..., Awaitable[None]]] = None,
+) -> int:
+    log.debug('opusenc = %r', opus_params)
+
+    start = time.perf_counter()
+    ffmpeg_sub = subprocess.Popen(
+        ffmpeg_params,
+        stdout=subprocess.DEVNULL if opus_params is None else subprocess.PIPE,
+        stdin=subprocess.DEVNULL if feed is None else subprocess.PIPE,
+        stderr=subprocess.DEVNULL if on_progress is None else subprocess.PIPE,
+    )
+
+    # with the ffmpeg backend there is no second process
+    last_sub = ffmpeg_sub
+    if opus_params is not None:
+        last_sub = subprocess.Popen(
+            opus_params,
+            stdin=ffmpeg_sub.stdout,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        # only opusenc should hold the read end
+        if ffmpeg_sub.stdout is not None:
+            ffmpeg_sub.stdout.close()
+    subs = [ffmpeg_sub] if last_sub is ffmpeg_sub else [ffmpeg_sub, last_sub]
+
+    last: dict = {}
+    tasks = []
+    transports = []
+    try:
+        if feed is not None:
+            stdin = await _pipe_writer(ffmpeg_sub.stdin)
+
+            async def _write(data: bytes) -> None:
+                stdin.write(data)
+                await stdin.drain()
+
+            async def _feed() -> None:
+                try:
+                    await feed(_write)
+                except Exception as e:
+                    # before closing, a short input would look like a complete encode
+                    log.error('Feeding ffmpeg failed: %s', e)
+                    _kill(ffmpeg_sub)
+                finally:
+                    stdin.close()
+
+            tasks.append(asyncio.create_task(_feed()))
+
+        if on_progress is not None:
+
+            def _progress(p: dict) -> None:
+                last.update(p)
+                on_progress(p)
+
+            reader, transport = await _pipe_reader(ffmpeg_sub.stderr)
+            transports.append(transport)
+            tasks.append(asyncio.create_task(_read_progress(reader, _progress)))
+
+        errors = None
+        if last_sub is not ffmpeg_sub:
+            # opusenc is --quiet, whatever it writes is why it failed
+            reader, transport = await _pipe_reader(last_sub.stderr)
+            transports.append(transport)
+            errors = asyncio.create_task(reader.read())
+            tasks.append(errors)
+
+        # ffmpeg is the producer, it finishes first
+        processes = [await _wait4_async(sub, start) for sub in subs]
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        _reap(subs, start)
+        raise
+    finally:
+        for transport in transports:
+            transport.close()
+
+    if stats is not None:
+        wall = time.perf_counter() - start
+        stats['wall'] = wall
+        stats['processes'] = processes
+
+        # what ffmpeg wrote, which is the PCM pipe when feeding opusenc
+        size = last.get('total_size')
+        if size is not None:
+            kind = 'pipe' if opus_params is not None else 'output'
+            stats[f'{kind}_bytes'] = size
+            stats[f'{kind}_throughput'] = size / wall if wall else None
+        if last.get('out_time') and wall:
+            stats['speed'] = last['out_time'] / wall
+
+    if ffmpeg_sub.returncode:
+        return ffmpeg_sub.returncode
+    if last_sub.returncode:
+        log.error(
+            'opusenc failed with %d: %s',
+            last_sub.returncode,
+            errors.result().decode('utf-8', errors='replace').strip(),  # type: ignore
+        )
+    return last_sub.returncode
+
+
+async def _communicate(params: list, data: bytes, stderr: bool = False) -> bytes:
+    # subprocess.run(params, input=data, check=True).stdout on the event loop,
+    # or what it wrote to stderr
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        params,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL if stderr else subprocess.PIPE,
+        stderr=subprocess.PIPE if stderr else subprocess.DEVNULL,
+    )
+    transport = None
+    try:
+        stdin = await _pipe_writer(process.stdin)
+        stdout, transport = await _pipe_reader(
+            process.stderr if stderr else process.stdout
+        )
+
+        async def _write() -> None:
+            try:
+                stdin.write(data)
+                await stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # the return code tells why
+                pass
+            finally:
+                stdin.close()
+
+        _, output = await asyncio.gather(_write(), stdout.read())
+        await _wait4_async(process, start)
+    except BaseException:
+        _reap([process], start)
+        raise
+    finally:
+        if transport is not None:
+            transport.close()
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, params)
+    return output
+
+
+async def _arnndn(model: str, chunk: bytes) -> bytes:
+    return await _communicate(
+        [
+            'ffmpeg',
+            '-loglevel',
+            'quiet',
+            '-hide_banner',
+            '-nostats',
+            '-f',
+            's16le',
+            '-ar',
+            str(VOICE_RATE),
+            '-ac',
+            '1',
+            '-i',
+            '-',
+            '-af',
+            f'arnndn=m={model}',
+            '-f',
+            's16le',
+            '-acodec',
+            'pcm_s16le',
+            '-',
+        ],
+        chunk,
+    )
+
+
+async def _isolate_voice(
+    model: str,
+    decoder_params: list,
+    jobs: int,
+    write: Callable[[bytes], Awaitable[None]],
+    stats: Optional[dict] = None,
+    splits: Sequence[float] = (),
+) -> None:
+    # arnndn is single threaded, so the decoded audio is cut in chunks that
+    # are denoised in parallel processes. Every chunk starts VOICE_WARMUP
+    # early so the network has settled by the time its own audio begins, and
+    # the end of that warm up is crossfaded with the end of the chunk before.
+    # Chunks end at the split point (seconds) nearest to VOICE_CHUNK.
+    warmup = VOICE_WARMUP * VOICE_RATE
+    fade = int(VOICE_CROSSFADE * VOICE_RATE)
+
+    start = time.perf_counter()
+    decoder = subprocess.Popen(
+        decoder_params,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+    held = array('h')
+
+    async def _emit(chunk: bytes, warm: int) -> None:
+        nonlocal held
+        data = array('h', chunk)
+        if held:
+            await write(
+                array(
+                    'h',
+                    (
+                        round(a + (b - a) * (n + 0.5) / fade)
+                        for n, (a, b) in enumerate(zip(held, data[warm - fade : warm]))
+                    ),
+                ).tobytes()
+            )
+        rest = data[warm:]
+        await write(rest[:-fade].tobytes())
+        held = rest[-fade:]
+
+    chunks = 0
+    pending: deque = deque()
+    transport = None
+    try:
+        stdout, transport = await _pipe_reader(decoder.stdout)
+        tail = b''
+        position = 0
+        while True:
+            cut = _snap(position / VOICE_RATE + VOICE_CHUNK, splits, VOICE_CHUNK / 4)
+            # on the frame grid of a single pass
+            size = round(cut * VOICE_RATE / VOICE_FRAME) * VOICE_FRAME - position
+            try:
+                block = await stdout.readexactly(size * 2)
+            except asyncio.IncompleteReadError as e:
+                block = e.partial
+            if not block:
+                break
+            position += len(block) // 2
+
+            # bounded read ahead, the output is written in order
+            while len(pending) >= jobs:
+                task, warm = pending.popleft()
+                await _emit(await task, warm)
+
+            pending.append(
+                (asyncio.create_task(_arnndn(model, tail + block)), len(tail) // 2)
+            )
+            tail = (tail + block)[-warmup * 2 :]
+            chunks += 1
+
+        while pending:
+            task, warm = pending.popleft()
+            await _emit(await task, warm)
+        await write(held.tobytes())
+        process = await _wait4_async(decoder, start)
+    except BaseException:
+        for task, _ in pending:
+            task.cancel()
+        _reap([decoder], start)
+        raise
+    finally:
+        if transport is not None:
+            transport.close()
+
+    if stats is not None:
+        stats['voice'] = {'chunks': chunks, 'jobs': jobs, 'decoder': process}
+
+    if decoder.returncode:
+        raise subprocess.CalledProcessError(decoder.returncode, decoder_params)
+
+
+def _split_time(
+    files: list[dict], seconds: float, points: Sequence[float] = ()
+) -> list[tuple[list[dict], float, Optional[float]]]:
+    # pieces of roughly the given duration, as the mp3 parts each one spans and
+    # where to cut them (seconds from the start of its first part). Cuts move
+    # to the nearest of the preferred points, if it isn't too far.
+    total = sum(f['duration'] for f in files)
+    n = max(1, round(total / seconds))
+
+    cuts = [0.0]
+    for k in range(1, n):
+        cut = _snap(total * k / n, points, seconds / 4)
+        cuts.append(cut if cut > cuts[-1] else total * k / n)
+    cuts.append(total)
+
+    ret = []
+    for k in range(n):
+        start = cuts[k]
+        end = cuts[k + 1]
+
+        offset = 0.0
+        span: list[dict] = []
+        span_start = 0.0
+        for f in files:
+            if offset < end and offset + f['duration'] > start:
+                if not span:
+                    span_start = offset
+                span.append(f)
+            offset += f['duration']
+
+        # the last one runs to the end of the audio, whatever its real length
+        ret.append((span, start - span_start, None if k == n - 1 else end - span_start))
+
+    return ret
+
+
+def _span(files: list[dict], start: float, end: float) -> list[dict]:
+    # the mp3 parts from start to end (seconds into the book), the first and
+    # last one with the points (seconds into the part) to start and end at
+    offset = 0.0
+    span = []
+    for f in files:
+        if offset < end and offset + f['duration'] > start:
+            span.append(dict(f, inpoint=max(0.0, start - offset), outpoint=None))
+            if end < offset + f['duration']:
+                span[-1]['outpoint'] = end - offset
+        offset += f['duration']
+    return span
+
+
+def _chapter_files(metadata: dict) -> list[tuple[str, list[dict]]]:
+    # every chapter with the mp3 parts it spans
+    chapters = metadata['chapters'] or [(metadata['title'], 0.0)]
+    ret = []
+    for n, (name, start) in enumerate(chapters):
+        end = chapters[n + 1][1] if n + 1 < len(chapters) else metadata['duration']
+        ret.append((name, _span(metadata['files'], start, end)))
+
+    return ret
+
+
+def _journal_load(journal: Path, header: dict) -> dict[int, int]:
+    # completed segments (and their size) of a previous run with the same
+    # header, anything after a torn write is ignored
+    done: dict[int, int] = {}
+    try:
+        with open(journal, 'r', encoding='utf-8') as f:
+            if json.loads(f.readline()) != header:
+                return {}
+            for line in f:
+                entry = json.loads(line)
+                done[entry['done']] = entry['size']
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError):
+        log.warning('Ignoring rest of journal %r', journal)
+
+    return done
+
+
+def _journal_append(journal: Path, entry: dict, truncate: bool = False) -> None:
+    with open(journal, 'w' if truncate else 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def encode_async(
+    folder: Path,
+    opus: Optional[Path] = None,
+    bitrate: float = 15,
+    subchapters: bool = False,
+    af: str | None = None,
+    progress: bool = True,
+    speed: int = 0,
+    normalize: Optional[int] = None,
+    isolate_voice: bool = False,
+    probe_jobs: Optional[int] = None,
+    cache: bool = True,
+    jobs: int = 1,
+    wav: bool = False,
+    encoder: str = 'opusenc',
+    stats: bool = False,
+    force: bool = False,
+    checkpoint: Optional[float] = None,
+    voice_jobs: int = 1,
+    loudnorm: Optional[float] = None,
+    split_chapters: bool = False,
+    timeout: Optional[float] = None,
+    pcm_cache: Optional[int] = None,
+    framesize: int = 60,
+    verify: bool = False,
+    cover_size: Optional[int] = None,
+    rate: int = 48000,
+) -> dict:
+    if speed < -99:
+        log.warning('Invalid speed: truncating to -99%')
+        speed = -50
+    speed_float = 1 + speed / 100.0
+
+    folder = Path(folder)
+    if opus is None:
+        log.warning('Guessing opus filename')
+        if split_chapters:
+            opus = folder.with_name(folder.name + ' - chapters')
+        else:
+            opus = folder.with_suffix('.opus')
+    opus = Path(opus)
+
+    log.info('Encoding from %s to %s', folder, opus)
+
+    # only what changes the output
+    params = {
+        'bitrate': bitrate,
+        'subchapters': subchapters,
+        'af': af,
+        'speed': speed,
+        'normalize': normalize,
+        'isolate_voice': isolate_voice,
+        'jobs': jobs,
+        'wav': wav,
+        'encoder': encoder,
+    }
+    if checkpoint is not None:
+        params['checkpoint'] = checkpoint
+    # chunked voice isolation has seams, unlike a single arnndn pass
+    voice_chunks = isolate_voice and voice_jobs > 1
+    if voice_chunks:
+        params['voice_jobs'] = voice_jobs
+    if loudnorm is not None:
+        params['loudnorm'] = loudnorm
+    if 60 != framesize:
+        params['framesize'] = framesize
+    if wav and 48000 != rate:
+        log.warning('WAV keeps the rate of the mp3 parts, ignoring rate %d', rate)
+        rate = 48000
+    if 48000 != rate:
+        params['rate'] = rate
+    if cover_size is not None:
+        params['cover_size'] = cover_size
+    if split_chapters:
+        # one file per chapter, there are no seams
+        params['split_chapters'] = True
+        del params['jobs']
+        if checkpoint is not None:
+            log.warning('Chapters are files of their own, ignoring checkpoint')
+            checkpoint = None
+            del params['checkpoint']
+    manifest = _manifest(folder, params)
+
+    # with split chapters opus is a directory, its files are checked later
+    if (
+        not split_chapters
+        and not force
+        and opus.exists()
+        and _read_manifest(opus) == manifest
+    ):
+        log.info('%s is up to date, skipping', opus)
+        result = {'folder': folder, 'output': opus, 'ok': True, 'skipped': True}
+        if verify:
+            # nothing is known about what it should be, only its structure
+            result['problems'] = await asyncio.to_thread(_verify_outputs, {opus: {}})
+            if result['problems']:
+                result.update(ok=False, error='Verification failed')
+        return result
+
+    # the blocking stages run in threads, the loop may be encoding other books
+    start = time.perf_counter()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    metadata = await asyncio.to_thread(
+        get_folder_metadata, folder, subchapters, probe_jobs, cache, cover_size
     )
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    metadata_stats = {
+        'wall': time.perf_counter() - start,
+        'cpu_user': after.ru_utime - before.ru_utime,
+        'cpu_sys': after.ru_stime - before.ru_stime,
+    }
+
+    if 0 == len(metadata['files']):
+        log.error('No mp3 files found. Nothing to encode')
+        raise FileNotFoundError
 
-    if ffmpeg_sub.stderr is None:
-        raise RuntimeError("Error running ffmpeg encoder")
+    gain = None
+    loudness_stats = None
+    if loudnorm is not None:
+        start = time.perf_counter()
+        gain = await asyncio.to_thread(
+            _loudnorm_gain,
+            metadata['files'],
+            loudnorm,
+            cache,
+            # chunked or not, arnndn comes before the gain
+            _filters(0, isolate_voice=isolate_voice),
+        )
+        loudness_stats = {'wall': time.perf_counter() - start, 'gain': gain}
 
-    progress_io = TextIOWrapper(ffmpeg_sub.stderr, newline=None, line_buffering=True)
-    opus_sub = subprocess.Popen(
-        opus_params,
-        stdin=ffmpeg_sub.stdout,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+    # only cut processing needs them
+    points: list[float] = []
+    silence_stats = None
+    if checkpoint is not None or voice_chunks or (jobs > 1 and not split_chapters):
+        start = time.perf_counter()
+        points = await asyncio.to_thread(_split_points, metadata['files'], cache)
+        silence_stats = {'wall': time.perf_counter() - start, 'points': len(points)}
+
+    raw_rate = None if wav else rate
+    # what comes before the rest of the filters can be kept in the PCM cache
+    front = _filters(0, isolate_voice=isolate_voice and not voice_chunks)
+    filters = front + _filters(speed, normalize, af=af, gain=gain)
+    voice = None
+    if voice_chunks:
+        voice_model = await asyncio.to_thread(_get_noise_model)
+        voice = (voice_model, voice_jobs)
+
+    log.info('%s files (%s)', len(metadata['files']), _time2str(metadata['duration']))
+
+    # every segment is some mp3 parts, optionally cut at the given times
+    if split_chapters:
+        chapters = _chapter_files(metadata)
+        groups = [(files, 0.0, None) for _, files in chapters]
+    elif checkpoint is not None:
+        groups = _split_time(metadata['files'], checkpoint, points)
+    else:
+        groups = _split_time(
+            metadata['files'], metadata['duration'] / max(1, jobs), points
+        )
+
+    offsets = {}
+    offset = 0.0
+    for f in metadata['files']:
+        offsets[str(f['file'])] = offset
+        offset += f['duration']
+
+    result = {
+        'folder': folder,
+        'output': opus,
+        'ok': False,
+        'skipped': False,
+        'title': metadata['title'],
+        'duration': metadata['duration'] / speed_float,
+        'chapters': len(metadata['chapters']),
+        'segments': len(groups),
+    }
+
+    # scratch files are written next to the output, /tmp might be too small.
+    # With checkpoints they are kept until the output is complete, so that
+    # an interrupted encode can carry on where it stopped.
+    if split_chapters:
+        opus.mkdir(exist_ok=True, parents=True)
+
+    if checkpoint is not None:
+        work = opus.with_name(f'.{opus.name}.work')
+        work.mkdir(exist_ok=True)
+        scratch = contextlib.nullcontext(str(work))
+    else:
+        scratch = tempfile.TemporaryDirectory(prefix=f'.{opus.name}.', dir=opus.parent)
+
+    with _ProgressBar(
+        metadata['title'], metadata['duration'] / speed_float, progress
+    ) as bar, scratch as tmp:
+
+        async def _encode(
+            files: list[dict],
+            output: Path,
+            tags: Optional[dict],
+            on_progress: Optional[Callable[[dict], None]],
+            stats: dict,
+            start: float = 0.0,
+            end: Optional[float] = None,
+        ) -> int:
+            trim = []
+            if start or end is not None:
+                # Decoding from the start of the part keeps the cut sample
+                # exact. mp3 timestamps don't start at 0, so count samples.
+                rate = files[0].get('sample_rate')
+                if rate:
+                    atrim = f'aresample={rate},atrim=start_sample={round(start * rate)}'
+                    if end is not None:
+                        atrim += f':end_sample={round(end * rate)}'
+                else:
+                    atrim = f'asetpts=PTS-STARTPTS,atrim=start={start:.6f}'
+                    if end is not None:
+                        atrim += f':end={end:.6f}'
+                trim = [atrim + ',asetpts=PTS-STARTPTS']
+
+            concat = None
+            listing = _concat_list(files)
+            if listing is not None:
+                concat = Path(tmp, output.stem + '.txt')
+                concat.write_text(listing, encoding='utf-8')
+            inputs = 1 if concat is not None else len(files)
+            kept = trim + front
+
+            feed = None
+            if voice_chunks:
+                origin = offsets[str(files[0]['file'])] + start
+                origin += files[0].get('inpoint') or 0
+                # decoding and arnndn happen before, ffmpeg gets their PCM
+                feed = partial(
+                    _isolate_voice,
+                    voice_model,
+                    _ffmpeg_params(
+                        files,
+                        trim,
+                        _pcm_output(VOICE_RATE),
+                        concat=concat,
+                        progress=False,
+                    ),
+                    voice_jobs,
+                    stats=stats,
+                    # relative to where this segment starts
+                    splits=[p - origin for p in points if p > origin],
+                )
+                trim = []
+                inputs = 1
+
+            chain = trim + filters
+            tee = None
+            if pcm_cache is not None:
+                # decoding, cutting and voice isolation are kept as FLAC, so
+                # encoder options and the later filters can change cheaply
+                entry = _pcm_cache_entry(files, kept, voice)
+                cut = len(trim) + len(front)
+                if entry.exists():
+                    log.info('Using cached PCM %s', entry)
+                    with contextlib.suppress(OSError):
+                        # eviction is by least recently used
+                        os.utime(entry)
+                    files, chain = [{'file': entry}], chain[cut:]
+                    concat, feed, inputs = None, None, 1
+                    stats['pcm_cache'] = 'hit'
+                else:
+                    entry.parent.mkdir(exist_ok=True, parents=True)
+                    # renamed when complete, encodes of the same book may race
+                    with tempfile.NamedTemporaryFile(
+                        dir=entry.parent, suffix='.tmp', delete=False
+                    ) as f:
+                        tee = (cut, Path(f.name))
+                    stats['pcm_cache'] = 'miss'
+
+            try:
+                if 'ffmpeg' == encoder:
+                    if tags is not None:
+                        tags_file = Path(tmp, output.stem + '.meta')
+                        tags_file.write_text(
+                            _ffmetadata(tags, speed_float, manifest), encoding='utf-8'
+                        )
+                    ret = await _run_pipeline(
+                        _ffmpeg_params(
+                            files,
+                            # the muxer takes granule positions from timestamps,
+                            # mp3 parts start late and leave gaps between them.
+                            # Counted at the encoder rate, they never round.
+                            chain
+                            + [f'aresample={raw_rate or 48000}', 'asetpts=N/SR/TB'],
+                            _libopus_output(
+                                bitrate,
+                                raw_rate,
+                                output,
+                                inputs if tags else None,
+                                framesize,
+                            ),
+                            [tags_file] if tags else [],
+                            concat,
+                            on_progress is not None,
+                            VOICE_RATE if feed is not None else None,
+                            tee,
+                        ),
+                        None,
+                        on_progress,
+                        stats,
+                        feed,
+                    )
+                else:
+                    opus_params = _opus_params(
+                        tags or metadata,
+                        bitrate,
+                        speed_float,
+                        tags=tags is not None,
+                        raw_rate=raw_rate,
+                        manifest=manifest,
+                        framesize=framesize,
+                    )
+                    ret = await _run_pipeline(
+                        _ffmpeg_params(
+                            files,
+                            chain,
+                            _pcm_output(raw_rate),
+                            concat=concat,
+                            progress=on_progress is not None,
+                            raw_input=VOICE_RATE if feed is not None else None,
+                            tee=tee,
+                        ),
+                        opus_params + ['-', str(output)],
+                        on_progress,
+                        stats,
+                        feed,
+                    )
+            except BaseException:
+                if tee is not None:
+                    tee[1].unlink(missing_ok=True)
+                raise
+
+            if tee is not None:
+                if ret:
+                    tee[1].unlink(missing_ok=True)
+                else:
+                    os.replace(tee[1], entry)
+                    _cache_evict('pcm', pcm_cache, '*.flac')
+            return ret
+
+        # -progress is also where the pipe statistics come from
+        track = progress or stats
+        pipelines: list[dict] = [{} for _ in groups]
+        stitch_wall = None
+        # the seams add audio, the verifier must expect what the stitcher made
+        length = result['duration']
+        encode_start = time.perf_counter()
+
+        done: list[dict] = [{} for _ in groups]
+
+        def _progress(n: int, p: dict) -> None:
+            done[n] = p
+            bar.update(
+                {
+                    'out_time': sum(d.get('out_time') or 0 for d in done),
+                    # all segments together
+                    'speed': sum(d.get('speed') or 0 for d in done),
+                }
+            )
+
+        async def _encode_book() -> list[int]:
+            nonlocal stitch_wall, length
+            if split_chapters:
+                width = max(2, len(str(len(chapters))))
+                outputs = []
+                for n, (name, _) in enumerate(chapters, start=1):
+                    name = re.sub(r'[\x00-\x1f/\\:*?"<>|]', '_', name).strip()
+                    outputs.append(opus / f'{n:0{width}d} - {name or "Chapter"}.opus')
+                result['files'] = outputs
+
+                todo = []
+                for n, output in enumerate(outputs):
+                    if (
+                        force
+                        or not output.exists()
+                        or _read_manifest(output) != manifest
+                    ):
+                        todo.append(n)
+                    else:
+                        done[n] = {
+                            'out_time': sum(
+                                (f['outpoint'] or f['duration']) - f['inpoint']
+                                for f in chapters[n][1]
+                            )
+                            / speed_float
+                        }
+                        pipelines[n] = {'skipped': True}
+                log.info('Encoding %d of %d chapters', len(todo), len(chapters))
+
+                limit = asyncio.Semaphore(max(1, jobs))
+
+                async def _encode_chapter(n: int) -> int:
+                    name, files = chapters[n]
+                    tags = dict(
+                        metadata,
+                        title=name.strip(),
+                        chapters=[],
+                        tracknumber=str(n + 1),
+                        tracktotal=str(len(chapters)),
+                    )
+
+                    # renamed when complete, a partial file would look up to date
+                    output = outputs[n].with_name(f'.{outputs[n].stem}.part.opus')
+                    try:
+                        async with limit:
+                            ret = await _encode(
+                                files,
+                                output,
+                                tags,
+                                partial(_progress, n) if track else None,
+                                pipelines[n],
+                            )
+                    except BaseException:
+                        output.unlink(missing_ok=True)
+                        raise
+                    if ret:
+                        output.unlink(missing_ok=True)
+                    else:
+                        os.replace(output, outputs[n])
+                    return ret
+
+                returncodes = await asyncio.gather(*map(_encode_chapter, todo))
+
+                if any(returncodes):
+                    log.error('Chapter encoding failed: %r', returncodes)
+                else:
+                    # chapters of an earlier run that are not made any more,
+                    # only those split from the very same files, anything
+                    # else (other books, whole book outputs) stays
+                    for f in set(_list_files(opus, 'opus')) - set(outputs):
+                        if _same_chapters(_read_manifest(f), manifest):
+                            log.info('Removing stale chapter %s', f)
+                            f.unlink(missing_ok=True)
+                return returncodes
+
+            if 1 == len(groups) and checkpoint is None:
+                # renamed when complete, its header would make a partial file
+                # look up to date, and a killed process cleans up nothing
+                output = Path(tmp, 'output.opus')
+                ret = await _encode(
+                    metadata['files'],
+                    output,
+                    metadata,
+                    bar.update if track else None,
+                    pipelines[0],
+                )
+                if 0 == ret:
+                    os.replace(output, opus)
+                return [ret]
+
+            segments = [Path(tmp, '%03d.opus' % n) for n in range(len(groups))]
+            nominal = [
+                (
+                    (end if end is not None else sum(f['duration'] for f in files))
+                    - start
+                )
+                / speed_float
+                for files, start, end in groups
+            ]
+            finished: dict[int, int] = {}
+
+            if checkpoint is not None:
+                journal = Path(tmp, 'journal')
+                header = {
+                    'manifest': manifest,
+                    'segments': [
+                        [str(f['file']) for f in files] + [start, end]
+                        for files, start, end in groups
+                    ],
+                }
+                if not force:
+                    finished = {
+                        n: size
+                        for n, size in _journal_load(journal, header).items()
+                        if n < len(segments)
+                        and segments[n].exists()
+                        and segments[n].stat().st_size == size
+                    }
+                if finished:
+                    log.info(
+                        'Resuming, %d of %d segments already encoded',
+                        len(finished),
+                        len(segments),
+                    )
+                else:
+                    _journal_append(journal, header, truncate=True)
+
+                for n in finished:
+                    done[n] = {'out_time': nominal[n]}
+                    pipelines[n] = {'resumed': True}
+
+            log.info('Encoding %d segments', len(groups) - len(finished))
+
+            limit = asyncio.Semaphore(max(1, min(jobs, len(groups))))
+
+            async def _encode_segment(n: int) -> int:
+                if n in finished:
+                    return 0
+
+                files, start, end = groups[n]
+                output = segments[n]
+                if checkpoint is not None:
+                    # a killed encoder must never leave a complete looking file
+                    output = segments[n].with_suffix('.part.opus')
+
+                # the first segment carries all the tags
+                async with limit:
+                    ret = await _encode(
+                        files,
+                        output,
+                        metadata if 0 == n else None,
+                        partial(_progress, n) if track else None,
+                        pipelines[n],
+                        start,
+                        end,
+                    )
+
+                if 0 == ret and checkpoint is not None:
+                    os.replace(output, segments[n])
+                    _journal_append(
+                        journal, {'done': n, 'size': segments[n].stat().st_size}
+                    )
+                return ret
+
+            returncodes = await asyncio.gather(
+                *map(_encode_segment, range(len(groups)))
+            )
+
+            if any(returncodes):
+                log.error('Segment encoding failed: %r', returncodes)
+                if checkpoint is not None:
+                    log.error('Run again to resume from %s', tmp)
+            else:
+                stitch_start = time.perf_counter()
+                # renamed in place so a half written output never looks done
+                stitched = Path(tmp, 'stitched.opus')
+                length = await asyncio.to_thread(
+                    _ogg_stitch, segments, nominal, stitched
+                )
+                os.replace(stitched, opus)
+                stitch_wall = time.perf_counter() - stitch_start
+
+                if checkpoint is not None:
+                    shutil.rmtree(tmp)
+            return returncodes
+
+        # cancelling kills the encoders, which clean up after themselves
+        try:
+            returncodes = await asyncio.wait_for(_encode_book(), timeout)
+        except asyncio.TimeoutError:
+            log.error('Encoding %s timed out after %s', opus, _time2str(timeout))
+            returncodes = [1]
+            result['error'] = 'timeout'
+        result['ok'] = not any(returncodes)
+
+        verify_wall = None
+        if verify and result['ok']:
+            verify_start = time.perf_counter()
+            picture = metadata['image'] is not None
+            if split_chapters:
+                expected = {
+                    output: {
+                        'duration': sum(
+                            (f['outpoint'] or f['duration']) - f['inpoint']
+                            for f in files
+                        )
+                        / speed_float,
+                        'chapters': 0,
+                        'picture': picture,
+                    }
+                    for output, (_, files) in zip(result['files'], chapters)
+                }
+            else:
+                expected = {
+                    opus: {
+                        'duration': length,
+                        'chapters': len(metadata['chapters']),
+                        'picture': picture,
+                    }
+                }
+            result['problems'] = await asyncio.to_thread(_verify_outputs, expected)
+            if result['problems']:
+                result.update(ok=False, error='Verification failed')
+            verify_wall = time.perf_counter() - verify_start
+
+        bar.done(result['ok'])
+
+    if not stats:
+        return result
+
+    encode_wall = time.perf_counter() - encode_start
+    result['stats'] = {
+        'metadata': metadata_stats,
+        'encode': {
+            'wall': encode_wall,
+            'speed': result['duration'] / encode_wall if encode_wall else None,
+            'pipelines': pipelines,
+        },
+    }
+    if loudness_stats is not None:
+        result['stats']['loudness'] = loudness_stats
+    if silence_stats is not None:
+        result['stats']['silence'] = silence_stats
+    if stitch_wall is not None:
+        result['stats']['stitch'] = {'wall': stitch_wall}
+    if verify_wall is not None:
+        result['stats']['verify'] = {'wall': verify_wall}
+
+    return result
+
+
+@wraps(encode_async)
+def encode(*args, **kwargs) -> dict:
+    # SIGINT cancels the encode, so the encoders are killed and cleaned up
+    return asyncio.run(encode_async(*args, **kwargs))
+
+
+def retag(
+    folder: Path,
+    opus: Optional[Path] = None,
+    subchapters: bool = False,
+    speed: Optional[int] = None,
+    probe_jobs: Optional[int] = None,
+    cache: bool = True,
+    cover_size: Optional[int] = None,
+) -> dict:
+    # Rewrites only the OpusTags header (chapters, tags, cover) of an existing
+    # output. Audio pages are copied as they are, only their sequence numbers
+    # and CRCs change if the new header needs a different number of pages.
+
+    folder = Path(folder)
+    if opus is None:
+        opus = folder.with_suffix('.opus')
+    opus = Path(opus)
+
+    # the options the file was encoded with, so the chapters match the audio
+    params: dict = {}
+    old_manifest = _read_manifest(opus)
+    if old_manifest is not None:
+        try:
+            params = json.loads(old_manifest)['params']
+        except (ValueError, KeyError, TypeError):
+            log.warning('Ignoring invalid manifest in %s', opus)
+
+    # the audio keeps its speed, only files without a manifest need to be told
+    if speed is None:
+        speed = params.get('speed', 0)
+    elif params and speed != params.get('speed', 0):
+        raise ValueError(
+            f'{opus} was encoded with speed {params.get("speed", 0)}, '
+            'retagging can not change it, encode it again instead'
+        )
+    # the cover is as large as it was encoded with unless asked otherwise
+    if cover_size is None:
+        cover_size = params.get('cover_size')
+
+    speed_float = 1 + speed / 100.0
+    metadata = get_folder_metadata(folder, subchapters, probe_jobs, cache, cover_size)
+
+    manifest = None
+    if params:
+        params.update(subchapters=subchapters, speed=speed)
+        params.pop('cover_size', None)
+        if cover_size is not None:
+            params['cover_size'] = cover_size
+        manifest = _manifest(folder, params)
+
+    tmp = opus.with_name(f'.{opus.name}.retag')
+    try:
+        with open(opus, 'rb') as f, open(tmp, 'wb') as out:
+            pages = _ogg_read_pages(f)
+
+            head_page = next(pages)
+            if head_page.body[:8] != b'OpusHead' or 1 != len(head_page.lacing):
+                raise ValueError(f'{opus} does not start with an OpusHead page')
+            out.write(_ogg_page_bytes(head_page))
+
+            # the old header may span several pages, it always ends a page
+            tags_pages = [next(pages)]
+            while 255 == tags_pages[-1].lacing[-1]:
+                tags_pages.append(next(pages))
+            old_tags = b''.join(p.body for p in tags_pages)
+            if 1 != sum(
+                1 for lace in b''.join(p.lacing for p in tags_pages) if lace < 255
+            ):
+                raise ValueError(f'{opus} has audio in the OpusTags pages')
+
+            vendor, old_comments = _opus_tags_parse(old_tags)
+
+            # segments don't end exactly where they should, the chapters after
+            # every seam are shifted the way the stitcher did it
+            seams = None
+            for c in old_comments:
+                key, _, value = c.partition(b'=')
+                if SEAMS_TAG == key.decode('utf-8', errors='replace').upper():
+                    seams = json.loads(value)
+            if seams is not None:
+                metadata['chapters'] = [
+                    (name, _seam_shift(t / speed_float, seams) * speed_float)
+                    for name, t in metadata['chapters']
+                ]
+            elif params.get('jobs', 1) > 1:
+                raise ValueError(
+                    f'{opus} was encoded in segments without recording the seams, '
+                    're-encode it with --force'
+                )
+
+            comments = _opus_comments(metadata, speed_float, manifest)
+            managed = {k.lower() for k, _ in comments} | {'metadata_block_picture'}
+
+            # keep what we don't write ourselves, like the encoder information
+            new_comments = [
+                c
+                for c in old_comments
+                if c.split(b'=', 1)[0].decode('utf-8', errors='replace').lower()
+                not in managed
+                and not re.match(rb'CHAPTER\d+(NAME)?=', c, re.IGNORECASE)
+            ]
+            new_comments.extend(_str2bytes(f'{k}={v}') for k, v in comments)
+
+            writer = OggWriter(out, head_page.serial, head_page.sequence + 1)
+            writer.write(_opus_tags_build(vendor, new_comments), 0, flush=True)
+
+            delta = writer.sequence - (tags_pages[-1].sequence + 1)
+            log.debug(
+                'OpusTags %d -> %d pages', len(tags_pages), len(tags_pages) + delta
+            )
+
+            if 0 == delta:
+                # the rest of the file is unchanged
+                shutil.copyfileobj(f, out, 1 << 20)
+            else:
+                for page in pages:
+                    if page.serial != head_page.serial:
+                        raise ValueError(f'{opus} has more than one logical stream')
+                    out.write(
+                        _ogg_page_bytes(page._replace(sequence=page.sequence + delta))
+                    )
+
+        os.replace(tmp, opus)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    return {
+        'folder': folder,
+        'output': opus,
+        'ok': True,
+        'title': metadata['title'],
+        'chapters': len(metadata['chapters']),
+    }
+
+
+async def _sdr(reference: Path, opus: Path) -> Optional[float]:
+    # signal to distortion ratio of the decoded opus file, in dB
+    log_text = await _communicate(
+        [
+            'ffmpeg',
+            '-hide_banner',
+            '-nostats',
+            '-loglevel',
+            'info',
+            '-f',
+            's16le',
+            '-ar',
+            '48000',
+            '-ac',
+            '1',
+            '-i',
+            reference,
+            '-i',
+            opus,
+            '-filter_complex',
+            '[0:a]aformat=sample_fmts=fltp[a];'
+            '[1:a]aformat=sample_fmts=fltp:channel_layouts=mono[b];[a][b]asdr',
+            '-f',
+            'null',
+            '-',
+        ],
+        b'',
+        stderr=True,
     )
+    match = re.search(rb'SDR ch0: (\S+) dB', log_text)
+    return None if match is None else _float(match.group(1).decode())
 
-    status = TextColumn('')
 
-    def __message(msg: str):
-        status.text_format = msg
+async def _sweep(
+    spans: list[list[dict]],
+    filters: list[str],
+    duration: float,
+    settings: list[tuple[float, int]],
+    encoder: str,
+    jobs: int,
+    rate: int = 48000,
+) -> list[dict]:
+    # the excerpts as every encoder gets them, before resampling
+    reference = b''.join(
+        await asyncio.gather(
+            *(
+                _communicate(
+                    _ffmpeg_params(span, filters, _pcm_output(48000), progress=False),
+                    b'',
+                )
+                for span in spans
+            )
+        )
+    )
+    seconds = len(reference) / 2 / 48000
+    log.info('Trying %d settings on %s of excerpts', len(settings), _time2str(seconds))
 
-    with Progress(
-        TextColumn(
-            f"[bold blue]{metadata['title']}",
-            justify="right",
-            table_column=Column(ratio=1),
-        ),
-        BarColumn(bar_width=None, table_column=Column(ratio=2)),
-        "[progress.percentage]{task.percentage:>3.0f}%",
-        status,
-        TimeRemainingColumn(),
-    ) as bar:
-        if progress:
-            total = metadata['duration'] / speed_float
-            task = bar.add_task('Encoding', total=total, start=False)
-            __message("[bold]Processing")
+    async def _feed(write: Callable[[bytes], Awaitable[None]]) -> None:
+        await write(reference)
 
-            progress_rx = re.compile(r'\s*time\s*=\s*(\S+)\s*')
+    limit = asyncio.Semaphore(jobs)
 
-        started = False
-        while opus_sub.poll() is None:
-            line = progress_io.readline()
-            log.debug('Progress line = %r', line)
+    with tempfile.TemporaryDirectory(prefix='overdrive2opus.sweep.') as tmp:
+        pcm = Path(tmp, 'reference.pcm')
+        pcm.write_bytes(reference)
+
+        async def _trial(bitrate: float, framesize: int) -> dict:
+            output = Path(tmp, f'{bitrate:g}-{framesize}.opus')
+            raw_rate = rate
+            stats: dict = {}
+            async with limit:
+                if 'ffmpeg' == encoder:
+                    ret = await _run_pipeline(
+                        _ffmpeg_params(
+                            [],
+                            [],
+                            _libopus_output(
+                                bitrate, raw_rate, output, framesize=framesize
+                            ),
+                            progress=False,
+                            raw_input=48000,
+                        ),
+                        None,
+                        None,
+                        stats,
+                        _feed,
+                    )
+                else:
+                    ret = await _run_pipeline(
+                        _ffmpeg_params(
+                            [],
+                            [],
+                            _pcm_output(raw_rate),
+                            progress=False,
+                            raw_input=48000,
+                        ),
+                        _opus_params(
+                            {},
+                            bitrate,
+                            1,
+                            tags=False,
+                            raw_rate=raw_rate,
+                            framesize=framesize,
+                        )
+                        + ['-', str(output)],
+                        None,
+                        stats,
+                        _feed,
+                    )
+                result: dict = {'bitrate': bitrate, 'framesize': framesize}
+                if ret:
+                    log.error('Encoding at %g kbit/s failed', bitrate)
+                    return dict(result, ok=False)
+                sdr = await _sdr(pcm, output)
+
+            size = output.stat().st_size
+            # per CPU second, the trials share the cores
+            cpu = sum(p['cpu_user'] + p['cpu_sys'] for p in stats['processes'])
+            return dict(
+                result,
+                ok=True,
+                size=size * duration / seconds,
+                kbps=size * 8 / seconds / 1000,
+                speed=seconds / cpu if cpu else None,
+                sdr=sdr,
+            )
+
+        return list(await asyncio.gather(*(_trial(*s) for s in settings)))
+
+
+def sweep(
+    folder: Path,
+    bitrates: Sequence[float] = SWEEP_BITRATES,
+    framesizes: Sequence[int] = (60,),
+    excerpts: int = SWEEP_EXCERPTS,
+    seconds: float = SWEEP_SECONDS,
+    subchapters: bool = False,
+    af: str | None = None,
+    speed: int = 0,
+    normalize: Optional[int] = None,
+    isolate_voice: bool = False,
+    loudnorm: Optional[float] = None,
+    probe_jobs: Optional[int] = None,
+    cache: bool = True,
+    encoder: str = 'opusenc',
+    jobs: Optional[int] = None,
+    rate: int = 48000,
+) -> list[dict]:
+    # Encodes excerpts at the start of evenly spaced chapters with every
+    # bitrate and framesize, and projects the size of the whole book. The
+    # quality is the signal to distortion ratio of the decoded excerpts.
+    folder = Path(folder)
+    metadata = get_folder_metadata(folder, subchapters, probe_jobs, cache)
+    if 0 == len(metadata['files']):
+        log.error('No mp3 files found. Nothing to encode')
+        raise FileNotFoundError
+
+    gain = None
+    if loudnorm is not None:
+        gain = _loudnorm_gain(
+            metadata['files'], loudnorm, cache, _filters(0, isolate_voice=isolate_voice)
+        )
+    filters = _filters(speed, normalize, isolate_voice, af, gain)
+
+    chapters = metadata['chapters'] or [(metadata['title'], 0.0)]
+    count = max(1, min(excerpts, len(chapters)))
+    spans = []
+    for i in range(count):
+        n = int((i + 0.5) * len(chapters) / count)
+        start = chapters[n][1]
+        end = chapters[n + 1][1] if n + 1 < len(chapters) else metadata['duration']
+        spans.append(_span(metadata['files'], start, min(end, start + seconds)))
+
+    settings = [(b, f) for b in bitrates for f in framesizes]
+    return asyncio.run(
+        _sweep(
+            spans,
+            filters,
+            metadata['duration'] / (1 + speed / 100.0),
+            settings,
+            encoder,
+            jobs or os.cpu_count() or 1,
+            rate,
+        )
+    )
+
+
+def _print_sweep(results: list[dict]) -> None:
+    def _num(value: Optional[float], fmt: str) -> str:
+        return '-' if value is None else format(value, fmt)
+
+    print(
+        f'{"kbit/s":>7} {"frame":>6} {"actual":>7} {"size":>11} {"speed":>7} {"SDR":>8}'
+    )
+    for r in results:
+        setting = f'{r["bitrate"]:>7g} {r["framesize"]:>4}ms'
+        if not r['ok']:
+            print(f'{setting} failed')
+            continue
+        print(
+            f'{setting} {r["kbps"]:>7.1f} {r["size"] / 1024**2:>7.1f} MiB'
+            f' {_num(r["speed"], ">6.0f")}x {_num(r["sdr"], ">5.1f")} dB'
+        )
 
-            if not progress:
-                continue
 
-            m = progress_rx.search(line)
-            if m:
-                timestr = m.group(1)
-                progress_time = _ts_from_time(timestr)
-                if progress_time > 0:
-                    if not started:
-                        __message("[bold cyan]Encoding")
-                        bar.start_task(task)
-                        started = True
-                    bar.update(task, completed=progress_time)
-        opus_sub.wait()
-        ffmpeg_sub.wait()
-        if progress:
-            if 0 == ffmpeg_sub.returncode:
-                __message("[bold green]:thumbs_up:")
+def _find_books(paths: list[str]) -> list[Path]:
+    # folders with mp3 files, parent folders of those or glob patterns
+    ret: list[Path] = []
+    for p in paths:
+        matches = [Path(m) for m in sorted(glob(p))] or [Path(p)]
+        for m in matches:
+            if not m.is_dir():
+                log.warning('Ignoring %r: not a directory', str(m))
+            elif _list_files(m, 'mp3'):
+                ret.append(m)
             else:
-                __message("[bold blink red]:thumbs_down:")
+                ret.extend(
+                    sorted(
+                        {f.parent for f in m.rglob('*') if f.suffix.lower() == '.mp3'}
+                    )
+                )
 
+    return list(dict.fromkeys(ret))
 
-parser = argparse.ArgumentParser(
-    description='Convert a OverDrive audiobook folder with an opus file '
-    'with thumbnail and chapter information',
-    formatter_class=Formatter,
-)
-parser.add_argument('--bitrate', type=int, help='opus bitrate in kbps', default=15)
-parser.add_argument('--subchapters', action='store_true', help='include subchapters')
-parser.add_argument(
-    '--noprogress', action='store_true', help='do not display encoding progress bar'
-)
-parser.add_argument(
-    '--speed',
-    type=int,
-    default=0,
-    help='speed up or down audio (signed integer %%). Chapters adjusted accordingly',
-)
-parser.add_argument(
-    '--normalize',
-    type=int,
-    default=None,
-    help='%% of max volume for dynamic normalization',
-)
-parser.add_argument(
-    '--isolate_voice',
-    action='store_true',
-    help='apply filter to isolate voice from background noise',
-)
-parser.add_argument(
-    '--filter',
-    type=str,
-    help='audio filter for fmmpeg. don\'t use unless you know what you are doing',
-    default=None,
-    required=False,
-)
-parser.add_argument('folder', type=str, help='input folder')
-parser.add_argument(
-    'opus_file', type=str, help='output opus file', default=None, nargs='?'
-)
-parser.add_argument(
-    '-v', '--verbose', help='increase output verbosity', action='store_true'
-)
 
-args = parser.parse_args()
+def encode_batch(
+    paths: list[str],
+    output_dir: Optional[Path] = None,
+    workers: Optional[int] = None,
+    progress: bool = True,
+    **kwargs,
+) -> list[dict]:
+    books = _find_books(paths)
+    if not books:
+        log.error('No audiobook folders found in %r', paths)
+        raise FileNotFoundError
+
+    # failed books and their error
+    failed: dict[Path, str] = {}
+    results: dict[Path, dict] = {}
 
+    durations = {}
+    for folder in books:
+        try:
+            metadata = get_folder_metadata(
+                folder,
+                kwargs.get('subchapters', False),
+                kwargs.get('probe_jobs'),
+                kwargs.get('cache', True),
+            )
+        except Exception as e:
+            log.error('Could not read %r: %s', str(folder), e)
+            failed[folder] = repr(e)
+            continue
+        if not metadata['files']:
+            failed[folder] = 'No mp3 files'
+            continue
+        durations[folder] = metadata['duration']
 
-__init_logging(args.verbose)
+    # longest books first so a long one doesn't start last and run alone
+    queue = sorted(durations, key=lambda f: durations[f], reverse=True)
 
-encode(
-    args.folder,
-    args.opus_file,
-    bitrate=args.bitrate,
-    subchapters=args.subchapters,
-    af=args.filter,
-    progress=not args.noprogress,
-    speed=args.speed,
-    normalize=args.normalize,
-    isolate_voice=args.isolate_voice,
-)
+    if kwargs.get('isolate_voice'):
+        # download it once before the workers race for it
+        _get_noise_model()
+
+    def _output(folder: Path) -> Path:
+        if kwargs.get('split_chapters'):
+            if output_dir is None:
+                return folder.with_name(folder.name + ' - chapters')
+            return Path(output_dir, folder.name)
+        if output_dir is None:
+            return folder.with_suffix('.opus')
+        return Path(output_dir, folder.name + '.opus')
+
+    if output_dir is not None:
+        Path(output_dir).mkdir(exist_ok=True, parents=True)
+
+    workers = workers or os.cpu_count() or 1
+    log.info('Encoding %d books with %d workers', len(queue), workers)
+
+    bar = None
+    if progress:
+        from rich.progress import BarColumn, Column, Progress, TextColumn
+        from rich.progress import TimeRemainingColumn
+
+        bar = Progress(
+            TextColumn('[bold blue]{task.description}', table_column=Column(ratio=1)),
+            BarColumn(bar_width=None, table_column=Column(ratio=2)),
+            "[progress.percentage]{task.percentage:>3.0f}%",
+            TextColumn('{task.fields[status]}'),
+            TimeRemainingColumn(),
+        )
+        bar.start()
+        total = bar.add_task(
+            'Library', total=sum(durations.values()), status=f'0/{len(queue)}'
+        )
+        tasks = {
+            folder: bar.add_task(
+                folder.name, total=durations[folder], status='[dim]queued'
+            )
+            for folder in queue
+        }
+
+    finished = 0
+    limit = asyncio.Semaphore(workers)
+
+    async def _encode(folder: Path) -> None:
+        nonlocal finished
+        async with limit:
+            if bar is not None:
+                bar.update(tasks[folder], status='[bold cyan]Encoding')
+            try:
+                results[folder] = await encode_async(
+                    folder, _output(folder), progress=False, **kwargs
+                )
+                if not results[folder]['ok']:
+                    failed[folder] = results[folder].get('error') or 'Encoder failed'
+            except Exception as e:
+                log.error('Failed encoding %r: %s', str(folder), e)
+                failed[folder] = repr(e)
+        finished += 1
+
+        if bar is not None:
+            if folder in failed:
+                status = '[bold blink red]:thumbs_down:'
+            elif results[folder].get('skipped'):
+                status = '[dim]up to date'
+            else:
+                status = '[bold green]:thumbs_up:'
+            bar.update(tasks[folder], completed=durations[folder], status=status)
+            bar.update(
+                total, advance=durations[folder], status=f'{finished}/{len(queue)}'
+            )
+
+    async def _encode_all() -> None:
+        await asyncio.gather(*map(_encode, queue))
+
+    # the books share one event loop, all the heavy lifting is in ffmpeg and
+    # opusenc, so there is no need for a process (or thread) per book
+    try:
+        asyncio.run(_encode_all())
+    finally:
+        if bar is not None:
+            bar.stop()
+
+    log.info('%d of %d books encoded', len(books) - len(failed), len(books))
+
+    return [
+        dict(
+            results.get(folder, {'folder': folder, 'output': _output(folder)}),
+            ok=folder not in failed,
+            error=failed.get(folder),
+        )
+        for folder in books
+    ]
+
+
+def _print_batch(results: list[dict]) -> None:
+    ok = sum(1 for r in results if r['ok'])
+    print(f'{ok} of {len(results)} books encoded')
+    for r in results:
+        if not r['ok']:
+            print(f'FAILED {r["folder"]}: {r["error"]}')
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    from argparse import HelpFormatter as Formatter
+
+    try:
+        from rich_argparse import RichHelpFormatter as Formatter
+    except ImportError:
+        pass
+
+    parser = argparse.ArgumentParser(
+        description='Convert a OverDrive audiobook folder with an opus file '
+        'with thumbnail and chapter information',
+        formatter_class=Formatter,
+    )
+    parser.add_argument('--bitrate', type=int, help='opus bitrate in kbps', default=15)
+    parser.add_argument(
+        '--subchapters', action='store_true', help='include subchapters'
+    )
+    parser.add_argument(
+        '--noprogress', action='store_true', help='do not display encoding progress bar'
+    )
+    parser.add_argument(
+        '--speed',
+        type=int,
+        default=None,
+        help='speed up or down audio (signed integer %%). Chapters adjusted '
+        'accordingly (default: 0). With --retag the speed the output was '
+        'encoded with, only needed for outputs without a manifest',
+    )
+    parser.add_argument(
+        '--normalize',
+        type=int,
+        default=None,
+        help='%% of max volume for dynamic normalization',
+    )
+    parser.add_argument(
+        '--loudnorm',
+        type=float,
+        nargs='?',
+        const=-18.0,
+        default=None,
+        metavar='LUFS',
+        help='two pass EBU R128 normalization to LUFS (default -18) with a '
+        'static gain, much cheaper than --normalize. The analysis of every mp3 '
+        'part (after --isolate_voice) is cached. --filter is applied after the '
+        'gain and is not measured',
+    )
+    parser.add_argument(
+        '--isolate_voice',
+        action='store_true',
+        help='apply filter to isolate voice from background noise',
+    )
+    parser.add_argument(
+        '--filter',
+        type=str,
+        help='audio filter for fmmpeg. don\'t use unless you know what you are doing',
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        '--probe_jobs',
+        type=int,
+        default=None,
+        help='number of concurrent ffprobe processes (default: automatic)',
+    )
+    parser.add_argument(
+        '--nocache',
+        action='store_true',
+        help='do not use the metadata, loudness, silence and cover caches '
+        '(--pcm_cache still applies)',
+    )
+    parser.add_argument(
+        '--clear_cache',
+        action='store_true',
+        help='clear the metadata, loudness, silence, cover and PCM caches before '
+        'doing anything else',
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=None,
+        help='encode this many segments (cut at pauses) in parallel '
+        'and join them afterwards. With --split_chapters the number of chapters '
+        'encoded at once (default: all cores, 1 with --batch)',
+    )
+    parser.add_argument(
+        '--split_chapters',
+        action='store_true',
+        help='write one opus file per chapter, with track numbers, into the '
+        'opus_file directory (default: "<folder> - chapters"). Chapter files '
+        'split from the same mp3 files by an earlier run that are not made any '
+        'more are removed',
+    )
+    parser.add_argument(
+        '--wav',
+        action='store_true',
+        help='pipe a WAV file to opusenc instead of raw mono PCM at --rate',
+    )
+    parser.add_argument(
+        '--encoder',
+        choices=('opusenc', 'ffmpeg'),
+        default='opusenc',
+        help='encode with opusenc fed by an ffmpeg pipe, or with libopus inside '
+        'ffmpeg. ffmpeg can not hint libopus that the signal is speech like '
+        'opusenc --speech does, it is detected instead',
+    )
+    parser.add_argument(
+        '--framesize',
+        type=int,
+        choices=(10, 20, 40, 60),
+        default=60,
+        help='opus frame size in ms',
+    )
+    parser.add_argument(
+        '--rate',
+        type=int,
+        choices=(8000, 12000, 16000, 24000, 48000),
+        default=48000,
+        help='sample rate the encoder gets. Lower rates save resampling but cap '
+        'the audio bandwidth at half the rate, below what libopus would keep '
+        'at most bitrates (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--cover_size',
+        type=int,
+        default=None,
+        metavar='PIXELS',
+        help='downscale covers larger than this on their longest side, '
+        'recompressed as JPEG once and cached (default: keep the cover as it is)',
+    )
+    parser.add_argument(
+        '--sweep',
+        action='store_true',
+        help='instead of encoding, encode excerpts of the book at several '
+        'bitrates and framesizes (in parallel, see --jobs) and print the '
+        'projected size, encoder speed and signal to distortion ratio of each',
+    )
+    parser.add_argument(
+        '--sweep_bitrates',
+        type=float,
+        nargs='+',
+        default=list(SWEEP_BITRATES),
+        metavar='KBPS',
+        help='bitrates tried by --sweep (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--sweep_framesizes',
+        type=int,
+        nargs='+',
+        choices=(10, 20, 40, 60),
+        default=None,
+        metavar='MS',
+        help='framesizes tried by --sweep (default: --framesize)',
+    )
+    parser.add_argument(
+        '--sweep_excerpts',
+        type=int,
+        default=SWEEP_EXCERPTS,
+        help=f'number of chapters --sweep takes {SWEEP_SECONDS} seconds from '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--voice_jobs',
+        type=int,
+        default=1,
+        help='run --isolate_voice on this many overlapping chunks in parallel '
+        '(crossfaded back together)',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        type=float,
+        metavar='MINUTES',
+        help='encode in segments of about MINUTES, kept next to the output until '
+        'it is complete, so an interrupted encode resumes where it stopped '
+        '(segments are encoded in parallel with --jobs)',
+    )
+    parser.add_argument(
+        '--pcm_cache',
+        type=float,
+        nargs='?',
+        const=PCM_CACHE_SIZE / 1024**3,
+        default=None,
+        metavar='GIB',
+        help='keep the decoded and voice isolated audio as FLAC in a cache of '
+        'GIB (default %(const)g, least recently used first out), so later '
+        'encodes that only change --bitrate, --encoder, --normalize, --loudnorm, '
+        '--speed or --filter start from it',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='MINUTES',
+        help='give up on a book whose encoding takes longer than MINUTES',
+    )
+    parser.add_argument(
+        '--retag',
+        action='store_true',
+        help='only rewrite chapters, tags and cover of an existing opus file '
+        '(no re-encoding)',
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='check the Ogg pages, duration, chapters and cover of the output '
+        'after encoding, without decoding it (an up to date output is checked '
+        'too)',
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='encode even if the output is up to date with the input and options',
+    )
+    parser.add_argument(
+        '--stats_json',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help='write timing and resource usage of every stage and process to FILE',
+    )
+    parser.add_argument(
+        '--batch',
+        nargs='+',
+        metavar='PATH',
+        help='encode every audiobook folder found in these folders or glob patterns',
+    )
+    parser.add_argument(
+        '--batch_jobs',
+        type=int,
+        default=None,
+        help='number of books encoded at the same time in batch mode (default: cpu count)',
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        default=None,
+        help='where batch mode writes the opus files (default: next to each folder)',
+    )
+    parser.add_argument('folder', type=str, help='input folder', nargs='?')
+    parser.add_argument(
+        'opus_file', type=str, help='output opus file', default=None, nargs='?'
+    )
+    parser.add_argument(
+        '-v', '--verbose', help='increase output verbosity', action='store_true'
+    )
+
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+
+    __init_logging(args.verbose)
+    log.debug('args = %r', args)
+
+    if args.normalize is not None and args.loudnorm is not None:
+        parser.error('--normalize and --loudnorm can not be used together')
+
+    if args.clear_cache:
+        clear_cache()
+
+    jobs = args.jobs
+    if jobs is None:
+        jobs = (os.cpu_count() or 1) if args.split_chapters and not args.batch else 1
+
+    options = dict(
+        bitrate=args.bitrate,
+        subchapters=args.subchapters,
+        af=args.filter,
+        speed=args.speed or 0,
+        normalize=args.normalize,
+        isolate_voice=args.isolate_voice,
+        probe_jobs=args.probe_jobs,
+        cache=not args.nocache,
+        jobs=jobs,
+        wav=args.wav,
+        encoder=args.encoder,
+        stats=args.stats_json is not None,
+        force=args.force,
+        checkpoint=args.checkpoint * 60 if args.checkpoint else None,
+        voice_jobs=args.voice_jobs,
+        loudnorm=args.loudnorm,
+        split_chapters=args.split_chapters,
+        timeout=args.timeout * 60 if args.timeout else None,
+        pcm_cache=int(args.pcm_cache * 1024**3) if args.pcm_cache else None,
+        framesize=args.framesize,
+        verify=args.verify,
+        cover_size=args.cover_size,
+        rate=args.rate,
+    )
+
+    def _write_stats(stats) -> None:
+        if args.stats_json is not None:
+            with open(args.stats_json, 'w') as f:
+                json.dump(stats, f, indent=2, default=str)
+
+    if args.batch is not None:
+        if args.folder is not None:
+            parser.error('folder and opus_file can not be used with --batch')
+        if args.retag:
+            parser.error('--retag can not be used with --batch')
+        if args.sweep:
+            parser.error('--sweep can not be used with --batch')
+        results = encode_batch(
+            args.batch,
+            output_dir=args.output_dir,
+            workers=args.batch_jobs,
+            progress=not args.noprogress,
+            **options,
+        )
+        _print_batch(results)
+        _write_stats({str(r['folder']): r.get('stats') for r in results})
+        return 0 if all(r['ok'] for r in results) else 1
+
+    if args.folder is None:
+        if args.clear_cache:
+            return 0
+        parser.error('the following arguments are required: folder')
+
+    if args.sweep:
+        if args.retag:
+            parser.error('--sweep can not be used with --retag')
+        results = sweep(
+            args.folder,
+            bitrates=args.sweep_bitrates,
+            framesizes=args.sweep_framesizes or [args.framesize],
+            excerpts=args.sweep_excerpts,
+            subchapters=args.subchapters,
+            af=args.filter,
+            speed=args.speed or 0,
+            normalize=args.normalize,
+            isolate_voice=args.isolate_voice,
+            loudnorm=args.loudnorm,
+            probe_jobs=args.probe_jobs,
+            cache=not args.nocache,
+            encoder=args.encoder,
+            jobs=args.jobs,
+            rate=args.rate,
+        )
+        _print_sweep(results)
+        _write_stats(results)
+        return 0 if all(r['ok'] for r in results) else 1
+
+    if args.retag:
+        if args.split_chapters:
+            parser.error('--retag can not be used with --split_chapters')
+        try:
+            retag(
+                args.folder,
+                args.opus_file,
+                subchapters=args.subchapters,
+                speed=args.speed,
+                probe_jobs=args.probe_jobs,
+                cache=not args.nocache,
+                cover_size=args.cover_size,
+            )
+        except ValueError as e:
+            log.error('%s', e)
+            return 1
+        return 0
+
+    result = encode(
+        args.folder,
+        args.opus_file,
+        progress=not args.noprogress,
+        **options,
+    )
+    _write_stats(result.get('stats'))
+    return 0 if result['ok'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+# Ogg page writer, reader and the segment stitcher on small synthetic Opus
+# streams. The packets are a CELT 20 ms TOC byte and filler, nothing decodes
+# them, only their sample counts matter.
+
+from pathlib import Path
+import io
+import json
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import overdrive2opus as o2o  # noqa: E402
+
+# CELT fullband, 20 ms, one frame
+TOC = 0xF8
+FRAME = 960
+PRE_SKIP = 480
+
+
+def opus_head(pre_skip: int = PRE_SKIP) -> bytes:
+    return b'OpusHead' + struct.pack('<BBHIhB', 1, 1, pre_skip, 48000, 0, 0)
+
+
+def audio(n: int, size: int = 20) -> list[bytes]:
+    return [bytes([TOC]) + bytes([k % 256]) * (size - 1) for k in range(n)]
+
+
+def write_opus(
+    path: Path,
+    packets: list[bytes],
+    comments: list[bytes] = [],
+    end_trim: int = 0,
+    serial: int = 1234,
+) -> None:
+    # the way the encoders do it: headers on pages of their own, the last
+    # granule position short of the padding
+    with open(path, 'wb') as f:
+        writer = o2o.OggWriter(f, serial)
+        writer.write(opus_head(), 0, flush=True)
+        writer.write(o2o._opus_tags_build(b'test', comments), 0, flush=True)
+        granule = 0
+        for n, packet in enumerate(packets):
+            granule += o2o._opus_samples(packet)
+            if n == len(packets) - 1:
+                writer.write(packet, granule - end_trim, eos=True)
+            else:
+                writer.write(packet, granule, flush=0 == (n + 1) % 50)
+
+
+def read_pages(data: bytes) -> list:
+    return list(o2o._ogg_read_pages(io.BytesIO(data)))
+
+
+class OggWriterTest(unittest.TestCase):
+    def _write(self, packets: list[bytes]) -> bytes:
+        f = io.BytesIO()
+        writer = o2o.OggWriter(f, 7)
+        for n, packet in enumerate(packets):
+            writer.write(packet, n + 1, eos=n == len(packets) - 1)
+        return f.getvalue()
+
+    def test_round_trip(self):
+        # lacing edge cases and a packet spanning several pages
+        packets = [
+            bytes([n % 256]) * size
+            for n, size in enumerate([0, 1, 254, 255, 256, 510, 511, 70000, 3])
+        ]
+        pages = read_pages(self._write(packets))
+
+        self.assertEqual([p for p, _ in o2o._ogg_packets(pages)], packets)
+        self.assertEqual([p.sequence for p in pages], list(range(len(pages))))
+        for page in pages:
+            self.assertEqual(page.crc, o2o._ogg_crc_of(page))
+            self.assertLessEqual(len(page.lacing), 255)
+        self.assertEqual(pages[0].flags & 0x02, 0x02)
+        self.assertEqual([p.flags & 0x04 for p in pages[:-1]], [0] * (len(pages) - 1))
+        self.assertEqual(pages[-1].flags & 0x04, 0x04)
+
+    def test_continued(self):
+        pages = read_pages(self._write([b'x' * 70000]))
+
+        self.assertGreater(len(pages), 1)
+        self.assertEqual(pages[0].flags & 0x01, 0)
+        for page in pages[1:]:
+            self.assertEqual(page.flags & 0x01, 0x01)
+        # no packet ends in them
+        for page in pages[:-1]:
+            self.assertEqual(page.granule, -1)
+        self.assertEqual(pages[-1].granule, 1)
+
+    def test_full_page_at_packet_boundary(self):
+        # 255 packets fill the first page exactly, nothing spans the boundary
+        pages = read_pages(self._write([b'x' * 10] * 300))
+
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(pages[0].granule, 255)
+        self.assertEqual(pages[1].flags, 0x04)
+
+    def test_crc(self):
+        page = read_pages(self._write([b'abc']))[0]
+        data = bytearray(o2o._ogg_page_bytes(page))
+        data[-1] ^= 0xFF
+
+        damaged = read_pages(bytes(data))[0]
+        self.assertNotEqual(damaged.crc, o2o._ogg_crc_of(damaged))
+
+
+class OggStitchTest(unittest.TestCase):
+    def test_stitch(self):
+        first = audio(60)
+        second = audio(30, 30)
+        end_trim = 100
+
+        with tempfile.TemporaryDirectory() as tmp:
+            segments = [Path(tmp, '000.opus'), Path(tmp, '001.opus')]
+            write_opus(
+                segments[0],
+                first,
+                [b'CHAPTER01=00:00:00.000', b'CHAPTER02=00:00:01.200'],
+                end_trim=500,
+            )
+            write_opus(segments[1], second, end_trim=end_trim, serial=99)
+
+            output = Path(tmp, 'stitched.opus')
+            # 1.2 s of book in the first segment
+            length = o2o._ogg_stitch(segments, [1.2, 0.6], output)
+            pages = read_pages(output.read_bytes())
+            # longer than the 1.8 s of book, by the seam
+            problems = o2o.verify_opus(output, duration=length)
+            self.assertFalse([p for p in problems if 'of audio' in p])
+
+        packets = [p for p, _ in o2o._ogg_packets(pages)]
+        head, tags = packets[:2]
+        self.assertEqual(head, opus_head())
+        # the padding of the first segment and the pre-skip of the second stay
+        self.assertEqual(packets[2:], first + second)
+
+        self.assertEqual({p.serial for p in pages}, {1234})
+        self.assertEqual([p.sequence for p in pages], list(range(len(pages))))
+        for page in pages:
+            self.assertEqual(page.crc, o2o._ogg_crc_of(page))
+        self.assertEqual([p.flags & 0x04 for p in pages].count(0x04), 1)
+        self.assertEqual(pages[-1].flags & 0x04, 0x04)
+
+        # only the end of the last segment is trimmed
+        total = (len(first) + len(second)) * FRAME
+        self.assertEqual(pages[-1].granule, total - end_trim)
+        self.assertAlmostEqual(length, (total - end_trim - PRE_SKIP) / 48000)
+        granules = [p.granule for p in pages[2:]]
+        self.assertEqual(granules, sorted(granules))
+
+        # the second chapter moves by the extra audio of the first segment
+        _, comments = o2o._opus_tags_parse(tags)
+        shifted = (len(first) * FRAME - PRE_SKIP) / 48000
+        self.assertIn(b'CHAPTER01=00:00:00.000', comments)
+        # recorded for retag
+        seams = [c for c in comments if c.startswith(b'OVERDRIVE2OPUS_SEAMS=')]
+        self.assertEqual(len(seams), 1)
+        self.assertEqual(
+            json.loads(seams[0].partition(b'=')[2]), [[0.0, 0.0], [1.2, shifted]]
+        )
+        self.assertIn(b'CHAPTER02=' + o2o._time2str(shifted).encode('ascii'), comments)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+# retag on synthetic Opus streams: the new OpusTags header replaces the old
+# one, the audio pages come through with their packets and granule positions.
+
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import overdrive2opus as o2o  # noqa: E402
+from test_ogg import FRAME, PRE_SKIP, audio, read_pages, write_opus  # noqa: E402
+
+
+def metadata(comment: str) -> dict:
+    return {
+        'title': 'New title',
+        'artist': 'Author',
+        'album': 'New title',
+        'genre': 'Audiobook',
+        'comment': comment,
+        'publisher': 'Publisher',
+        'copyright': None,
+        'chapters': [('One', 0.0), ('Two', 0.5)],
+        'image': None,
+    }
+
+
+class RetagTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.packets = audio(200)
+        self.opus = Path(self.tmp.name, 'book.opus')
+        write_opus(
+            self.opus,
+            self.packets,
+            [b'ENCODER=test', b'TITLE=Old title', b'CHAPTER01=00:00:00.000'],
+            end_trim=300,
+        )
+        self.before = read_pages(self.opus.read_bytes())
+
+    def _retag(self, comment: str) -> list:
+        with mock.patch.object(
+            o2o, 'get_folder_metadata', return_value=metadata(comment)
+        ):
+            result = o2o.retag(Path(self.tmp.name, 'book'), self.opus)
+        self.assertEqual(result['chapters'], 2)
+
+        duration = (len(self.packets) * FRAME - PRE_SKIP - 300) / 48000
+        self.assertEqual(
+            o2o.verify_opus(self.opus, duration=duration, chapters=2, picture=None),
+            [],
+        )
+        return read_pages(self.opus.read_bytes())
+
+    def _header_pages(self, pages: list) -> int:
+        # OpusHead and the pages the OpusTags packet ends on
+        n = 1
+        while 255 == pages[n].lacing[-1]:
+            n += 1
+        return n + 1
+
+    def _check_audio(self, pages: list) -> None:
+        packets = [p for p, _ in o2o._ogg_packets(pages)]
+        self.assertEqual(packets[2:], self.packets)
+
+        self.assertEqual(
+            [p.granule for p in pages[self._header_pages(pages) :]],
+            [p.granule for p in self.before[2:]],
+        )
+        self.assertEqual([p.sequence for p in pages], list(range(len(pages))))
+        for page in pages:
+            self.assertEqual(page.crc, o2o._ogg_crc_of(page))
+
+    def _comments(self, pages: list) -> list[bytes]:
+        tags = [p for p, _ in o2o._ogg_packets(pages)][1]
+        return o2o._opus_tags_parse(tags)[1]
+
+    def test_same_pages(self):
+        pages = self._retag('Short')
+
+        self.assertEqual(self._header_pages(pages), 2)
+        self._check_audio(pages)
+        # the audio pages are the same bytes
+        self.assertEqual(pages[2:], self.before[2:])
+
+        comments = self._comments(pages)
+        self.assertIn(b'ENCODER=test', comments)
+        self.assertIn(b'title=New title', comments)
+        self.assertNotIn(b'TITLE=Old title', comments)
+        self.assertIn(b'CHAPTER02=00:00:00.500', comments)
+
+    def test_more_pages(self):
+        # too long for one page
+        pages = self._retag('x' * 100000)
+
+        self.assertGreater(self._header_pages(pages), 2)
+        self._check_audio(pages)
+        self.assertIn(b'description=' + b'x' * 100000, self._comments(pages))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# verify_opus on a valid synthetic Opus stream and on copies of it that are
+# damaged in one way each.
+
+from pathlib import Path
+import base64
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import overdrive2opus as o2o  # noqa: E402
+from test_ogg import FRAME, PRE_SKIP, audio, read_pages, write_opus  # noqa: E402
+
+CHAPTERS = [
+    b'CHAPTER01=00:00:00.000',
+    b'CHAPTER01NAME=One',
+    b'CHAPTER02=00:00:00.500',
+    b'CHAPTER02NAME=Two',
+]
+
+
+def png(width: int, height: int) -> bytes:
+    # the signature and IHDR is all the verifier and _image_info look at
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (
+        o2o.PNG_SIGNATURE
+        + struct.pack('>I', len(ihdr))
+        + b'IHDR'
+        + ihdr
+        + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr))
+    )
+
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        cover = Path(self.tmp.name, 'cover.png')
+        cover.write_bytes(png(40, 30))
+        self.picture = o2o._picture_block(cover)
+
+        self.packets = audio(60)
+        self.duration = (len(self.packets) * FRAME - PRE_SKIP) / 48000
+
+    def _write(self, comments: list[bytes]) -> Path:
+        path = Path(self.tmp.name, 'book.opus')
+        write_opus(path, self.packets, comments)
+        return path
+
+    def _verify(self, path: Path, **kwargs) -> list[str]:
+        expected = dict(duration=self.duration, chapters=2, picture=True)
+        expected.update(kwargs)
+        return o2o.verify_opus(path, **expected)
+
+    def test_valid(self):
+        path = self._write(
+            CHAPTERS + [b'METADATA_BLOCK_PICTURE=' + self.picture.encode()]
+        )
+
+        self.assertEqual(self._verify(path), [])
+
+    def test_bad_crc(self):
+        path = self._write(CHAPTERS)
+        data = bytearray(path.read_bytes())
+        data[-1] ^= 0xFF
+        path.write_bytes(data)
+
+        problems = self._verify(path, picture=None)
+        self.assertEqual(len(problems), 1)
+        self.assertRegex(problems[0], 'bad CRC')
+
+    def test_no_eos(self):
+        path = self._write(CHAPTERS)
+        pages = read_pages(path.read_bytes())
+        pages[-1] = pages[-1]._replace(flags=pages[-1].flags & ~0x04)
+        path.write_bytes(b''.join(o2o._ogg_page_bytes(p) for p in pages))
+
+        self.assertEqual(
+            self._verify(path, picture=None),
+            ['the last page has no end of stream flag'],
+        )
+
+    def test_truncated(self):
+        path = self._write(CHAPTERS)
+        path.write_bytes(path.read_bytes()[:-10])
+
+        problems = self._verify(path, picture=None)
+        self.assertIn('page 3 is truncated', problems)
+        # nothing is known about the length any more
+        self.assertFalse([p for p in problems if 'of audio' in p])
+
+    def test_missing_chapter_name(self):
+        path = self._write(CHAPTERS[:3])
+
+        self.assertEqual(
+            self._verify(path, picture=None), ['chapter 2 has no start or no name']
+        )
+
+    def test_duration(self):
+        path = self._write(CHAPTERS)
+
+        problems = self._verify(path, duration=self.duration + 5, picture=False)
+        self.assertEqual(len(problems), 1)
+        self.assertRegex(problems[0], 'of audio, expected')
+
+
+class CheckTagsTest(unittest.TestCase):
+    def test_chapters(self):
+        self.assertEqual(o2o._check_tags(CHAPTERS, 1, 2), [])
+        self.assertEqual(
+            o2o._check_tags(CHAPTERS, 0.25, None),
+            ['chapter 2 starts at 00:00:00.500, after the end'],
+        )
+        self.assertEqual(
+            o2o._check_tags(list(reversed(CHAPTERS)), 1, 3), ['2 chapters, expected 3']
+        )
+        self.assertEqual(
+            o2o._check_tags(CHAPTERS[2:], 1, None),
+            ['chapters are not numbered 1 to 1'],
+        )
+
+
+class CheckPictureTest(unittest.TestCase):
+    def _block(self, mime: bytes, size: tuple[int, int], data: bytes) -> str:
+        block = (
+            struct.pack('>II', 3, len(mime))
+            + mime
+            + struct.pack('>IIIIII', 0, *size, 24, 0, len(data))
+            + data
+        )
+        return base64.b64encode(block).decode('ascii')
+
+    def test_valid(self):
+        self.assertIsNone(
+            o2o._check_picture(self._block(b'image/png', (4, 3), png(4, 3)))
+        )
+        # unknown dimensions
+        self.assertIsNone(
+            o2o._check_picture(self._block(b'image/png', (0, 0), png(4, 3)))
+        )
+
+    def test_invalid(self):
+        self.assertEqual(
+            o2o._check_picture(self._block(b'image/png', (5, 3), png(4, 3))),
+            'picture is 4x3, not 5x3',
+        )
+        self.assertEqual(
+            o2o._check_picture(self._block(b'image/jpeg', (4, 3), png(4, 3))),
+            'picture is not image/jpeg',
+        )
+        truncated = base64.b64decode(self._block(b'image/png', (4, 3), png(4, 3)))
+        self.assertRegex(
+            o2o._check_picture(base64.b64encode(truncated[:-5]).decode()),
+            'bytes of image',
+        )
+        self.assertRegex(o2o._check_picture('not base64!'), 'invalid')
+
+
+if __name__ == '__main__':
+    unittest.main()